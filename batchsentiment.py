@@ -0,0 +1,264 @@
+#!./venv/bin/python3
+
+# score the sentiment of many messages at once, using the same lexicon as TextBlob's
+# default (pattern) analyzer but tokenizing a whole batch together and scoring with numpy arrays.
+#
+# pattern scores a message by walking its words one by one; here the common cases are
+# done with array shifts over all the words of the batch instead:
+#   - known words count with their lexicon polarity / subjectivity
+#   - a known adverb before a known word scales it by the adverb's intensity ("very good", "really is a good")
+#   - a negation before a known word (or before its adverb) flips and halves it ("not good", "not a good")
+#   - so does a negation after an -ly adverb ("really not good")
+#   - each "!" boosts the polarity of the word before it by 25%
+#   - emoticons count as fully subjective words
+# chains of these (several negations or adverbs in a row, "!" between an adverb and its word,
+# an emoticon before a word) interact in ways that aren't reproduced, so texts with any two of them
+# within CHAIN_DISTANCE words of each other are scored by TextBlob itself. that's about a sixth of
+# chat messages; every message agrees with TextBlob to within BATCH_TOLERANCE.
+# test_batchsentiment.py checks this, and running this file on a chat history reports it.
+import sys, re
+import numpy as np # https://www.numpy.org/
+from textblob import TextBlob # https://textblob.readthedocs.io/
+from textblob.en import sentiment as pattern_sentiment
+from textblob import _text as pattern_text
+
+BATCH_TOLERANCE = 0.01
+BATCH_SIZE = 2000
+CHAIN_DISTANCE = 2 # in words, not counting the short unknown ones pattern skips over
+
+# same tokenization rules as pattern's find_tokens
+PUNCTUATION = pattern_text.PUNCTUATION
+LEADING_PUNCTUATION = PUNCTUATION.replace(".", "")
+NEGATIONS = set(pattern_sentiment.negations)
+EMOTICONS = {}
+for (_, p), faces in pattern_text.EMOTICONS.items():
+    for face in faces:
+        EMOTICONS[face.lower()] = p
+
+SEPARATOR = "\x00" # token between messages of a batch
+RE_REPLACEMENTS = re.compile("|".join(re.escape(k) for k in pattern_text.replacements))
+RE_QUOTES = re.compile("([“”‘’'\"])")
+RE_LINEBREAK = re.compile(r"\n{2,}")
+RE_PLAIN = re.compile(r"^[^" + re.escape(PUNCTUATION) + r"]*$")
+
+class BatchScorer:
+    def __init__(self):
+        if dict.__len__(pattern_sentiment) == 0:
+            pattern_sentiment.load()
+        words = list(dict.keys(pattern_sentiment))
+        self.vocab = {w: i for i, w in enumerate(words)}
+        scores = np.array([dict.__getitem__(pattern_sentiment, w)[None] for w in words], dtype=float).reshape(-1, 3)
+        self.polarity = scores[:, 0]
+        self.subjectivity = scores[:, 1]
+        self.intensity = scores[:, 2]
+        self.modifier = np.array([any(m in dict.__getitem__(pattern_sentiment, w) for m in pattern_sentiment.modifiers)
+            for w in words], dtype=bool)
+        self.lyadverb = np.array([pattern_sentiment.modifier(w) for w in words], dtype=bool)
+
+    # split every text into lowercase tokens the way pattern does, all at once.
+    # returns the tokens and, for each, the index of the text it came from
+    def tokenize(self, texts):
+        joined = (" " + SEPARATOR + " ").join(texts)
+        joined = RE_REPLACEMENTS.sub(lambda m: " " + m.group(0), joined)
+        joined = RE_QUOTES.sub(r" \1 ", joined)
+        joined = RE_LINEBREAK.sub(" ", joined.replace("\r\n", "\n"))
+
+        split = []
+        for t in joined.split():
+            if RE_PLAIN.match(t):
+                split.append(t)
+            else:
+                split.extend(split_punctuation(t))
+
+        # put emoticons split up by the punctuation rules back together
+        joined = " ".join(split)
+        joined = pattern_text.RE_SARCASM.sub("(!)", joined)
+        joined = pattern_text.RE_EMOTICONS.sub(lambda m: m.group(1).replace(" ", "") + m.group(2), joined)
+
+        tokens = []
+        owners = []
+        owner = 0
+        for t in joined.split():
+            if t == SEPARATOR:
+                owner += 1
+                continue
+            tokens.append(t.lower())
+            owners.append(owner)
+        return tokens, np.array(owners, dtype=np.int64)
+
+    # (polarities, subjectivities) arrays, one entry per text
+    def score(self, texts):
+        n = len(texts)
+        tokens, owner = self.tokenize(texts)
+        if len(tokens) == 0:
+            return np.zeros(n), np.zeros(n)
+
+        vocab = self.vocab
+        ids = np.array([vocab.get(t, -1) for t in tokens], dtype=np.int64)
+        negation = np.array([t in NEGATIONS for t in tokens], dtype=bool)
+        exclaim = np.array([t == "!" for t in tokens], dtype=bool)
+        emoticon = np.array([EMOTICONS.get(t, np.nan) if not t.isalpha() and t not in PUNCTUATION else np.nan
+            for t in tokens])
+
+        known = ids >= 0
+        safe = np.where(known, ids, 0)
+        p = np.where(known, self.polarity[safe], 0.0)
+        s = np.where(known, self.subjectivity[safe], 0.0)
+        intensity = np.where(known, self.intensity[safe], 1.0)
+        modifier = known & self.modifier[safe]
+
+        # pattern keeps an adverb pending across unknown words of up to 2 letters,
+        # and a negation across unknown words of 1 letter (ignoring apostrophes)
+        lengths = np.array([len(t) for t in tokens])
+        short = np.array([len(t.strip("'")) <= 1 for t in tokens], dtype=bool)
+        adverb_before = previous(~known & (lengths <= 2), owner)
+        negation_before = previous(~known & short & ~negation, owner)
+
+        lyadverb = known & self.lyadverb[safe]
+        chained = self.chained(owner, n, known, safe, lengths, negation | exclaim | ~np.isnan(emoticon), ~np.isnan(emoticon))
+
+        # a known adverb before a known word
+        has = adverb_before >= 0
+        adverb = np.where(has, adverb_before, 0)
+        modified = known & has & modifier[adverb]
+
+        # or an -ly adverb and a negation before a known word ("really not good")
+        unknown_negation = ~known & negation
+        after_negation = np.where(has, previous(~known & (lengths <= 2), owner)[adverb], -1)
+        ly_negated = known & has & ~modified & unknown_negation[adverb] & (after_negation >= 0)
+        ly_negated[ly_negated] = lyadverb[after_negation[ly_negated]]
+        adverb = np.where(ly_negated, after_negation, adverb)
+        modified |= ly_negated
+
+        # negation before the start of "[adverb] word"
+        start = np.where(modified, adverb, np.arange(len(tokens)))
+        before = negation_before[start]
+        negated = known & (before >= 0) & negation[np.maximum(before, 0)]
+
+        # an -ly adverb negated after it, with nothing for it to modify
+        after = following(~known & (lengths <= 2), owner)
+        self_negated = lyadverb & (after >= 0)
+        self_negated[self_negated] = unknown_negation[after[self_negated]]
+
+        # adverbs followed by a known word are folded into that word's score
+        absorbed = np.zeros(len(tokens), dtype=bool)
+        absorbed[adverb[modified]] = True
+        scale = np.where(modified, np.where(negated, 1.0 / intensity[adverb], intensity[adverb]), 1.0)
+        negated |= ly_negated | (self_negated & ~absorbed)
+        p = np.clip(p * scale, -1.0, 1.0)
+        s = np.clip(s * scale, -1.0, 1.0)
+
+        isemoticon = ~known & ~np.isnan(emoticon)
+        p = np.where(isemoticon, np.nan_to_num(emoticon), p)
+        s = np.where(isemoticon, 1.0, s)
+
+        entry = (known & ~absorbed) | isemoticon
+        positions = np.flatnonzero(entry)
+
+        # "!" boosts the last scored word before it in the same text
+        bangs = np.flatnonzero(exclaim)
+        if len(positions) > 0 and len(bangs) > 0:
+            last = np.searchsorted(positions, bangs) - 1
+            ok = last >= 0
+            last = last[ok]
+            same = owner[positions[last]] == owner[bangs[ok]]
+            boosts = np.bincount(last[same], minlength=len(positions))
+            p[positions] = np.clip(p[positions] * (1.25 ** boosts), -1.0, 1.0)
+
+        p = np.where(negated, p * -0.5, p)
+
+        counts = np.bincount(owner[positions], minlength=n)
+        polarity = np.bincount(owner[positions], weights=p[positions], minlength=n)
+        subjectivity = np.bincount(owner[positions], weights=s[positions], minlength=n)
+        divisor = np.maximum(counts, 1)
+        polarity, subjectivity = polarity / divisor, subjectivity / divisor
+        for i in np.flatnonzero(chained).tolist():
+            polarity[i], subjectivity[i] = TextBlob(texts[i]).sentiment
+        return polarity, subjectivity
+
+    # for each text, whether it has a chain of negations, adverbs, "!"s or emoticons that score()
+    # can't reproduce: one of them within CHAIN_DISTANCE of another, or an emoticon that close before a known word
+    def chained(self, owner, n, known, safe, lengths, special, emoticon):
+        special = special | (known & (self.modifier[safe] | self.lyadverb[safe] | (self.intensity[safe] != 1)))
+        position = np.cumsum(known | special | (lengths > 2))
+        chain = np.zeros(len(owner), dtype=bool)
+        for before, after in ((special, special), (emoticon, known)):
+            prev = previous(~before, owner)
+            chain |= after & (prev >= 0) & (position - position[np.maximum(prev, 0)] <= CHAIN_DISTANCE)
+        chained = np.zeros(n, dtype=bool)
+        chained[owner[chain]] = True
+        return chained
+
+# for each token, the index of the closest token before it in the same text
+# that isn't skippable, or -1 if there isn't one
+def previous(skippable, owner):
+    index = np.arange(len(skippable))
+    last = np.maximum.accumulate(np.where(skippable, -1, index))
+    prev = np.full(len(skippable), -1)
+    prev[1:] = last[:-1]
+    ok = prev >= 0
+    ok[ok] = owner[prev[ok]] == owner[ok]
+    return np.where(ok, prev, -1)
+
+# same, for the closest token after it
+def following(skippable, owner):
+    n = len(skippable)
+    prev = previous(skippable[::-1], owner[::-1])[::-1]
+    return np.where(prev >= 0, n - 1 - prev, -1)
+
+# split leading and trailing punctuation off a token, as pattern's find_tokens does
+def split_punctuation(t):
+    head = []
+    tail = []
+    while t and t[0] in LEADING_PUNCTUATION and t not in pattern_text.replacements:
+        head.append(t[0])
+        t = t[1:]
+    while t and t[-1] in PUNCTUATION and t not in pattern_text.replacements:
+        if t[-1] in LEADING_PUNCTUATION:
+            tail.append(t[-1])
+            t = t[:-1]
+        if t.endswith("..."):
+            tail.append("...")
+            t = t[:-3].rstrip(".")
+        if t.endswith("."):
+            if t in pattern_text.ABBREVIATIONS or pattern_text.RE_ABBR1.match(t) or \
+                    pattern_text.RE_ABBR2.match(t) or pattern_text.RE_ABBR3.match(t):
+                break
+            tail.append(".")
+            t = t[:-1]
+    if t != "":
+        head.append(t)
+    head.extend(reversed(tail))
+    return head
+
+SCORER = None
+
+def score_batch(texts):
+    global SCORER
+    if SCORER is None:
+        SCORER = BatchScorer()
+    return SCORER.score(texts)
+
+# compare against TextBlob on the messages of a chat history
+def check_agreement(texts, tolerance=BATCH_TOLERANCE):
+    polarity, subjectivity = score_batch(texts)
+    worst = 0
+    within = 0
+    for i, text in enumerate(texts):
+        expected = TextBlob(text).sentiment
+        diff = max(abs(expected.polarity - polarity[i]), abs(expected.subjectivity - subjectivity[i]))
+        worst = max(worst, diff)
+        if diff <= tolerance:
+            within += 1
+    return (within, len(texts), worst)
+
+def main():
+    import messages as msgs
+    historyfile = sys.argv[1] if len(sys.argv) > 1 else msgs.TEST_FILE
+    texts = [m["content"] for m in msgs.iter_messages(historyfile) if "content" in m]
+    within, total, worst = check_agreement(texts)
+    print("{} / {} messages within {} of TextBlob (largest difference {})".format(within, total, BATCH_TOLERANCE, round(worst, 3)))
+    return
+
+if __name__ == '__main__':
+    main()
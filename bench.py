@@ -0,0 +1,125 @@
+#!./venv/bin/python3
+
+# time parts of the analysis on the messages of a chat history, against the way they used to be done.
+# usage: ./bench.py [history_json_filename] [benchmark ...]
+import sys, time
+import messages as msgs
+
+REPEATS = 3
+
+# best time of REPEATS runs of func(), in seconds
+def best_time(func):
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+# old() and new() each handle count messages
+def report(name, count, old, new):
+    told = best_time(old)
+    tnew = best_time(new)
+    print("{}: {} messages".format(name, count))
+    print("\tbefore: {:.3f} s ({:.0f} messages/s)".format(told, count / told))
+    print("\tafter:  {:.3f} s ({:.0f} messages/s)".format(tnew, count / tnew))
+    print("\t{:.1f}x faster".format(told / tnew))
+    return
+
+# emoji extraction as it was: walk the text a character at a time, guessing how many
+# characters each emoji's utf-8 bytes were spread over from the first one
+def legacy_find_emoji(content):
+    found = []
+    i = 0
+    while i < len(content):
+        ch = content[i]
+        chsize = 1
+        if ch == 'ð': # emoticon or symbol
+            if i+7 < len(content) and content[i+2] == '\u0087': # country code, 8 bytes
+                chsize = 8
+            else: # 4 "bytes"
+                chsize = 4
+        elif ch == 'â' or ch == 'ã': # dingbat or other 3 "bytes"
+            chsize = 3
+        elif ch == 'Â': # copyright or registered sign
+            chsize = 2
+
+        if chsize != 1:
+            if i + chsize <= len(content):
+                found.append(msgs.weirdbytes_to_utf(content[i:i+chsize]))
+        i += chsize
+    return found
+
+def contents(historyfile, repair=True):
+    return [m["content"] for m in msgs.iter_messages(historyfile, repair=repair) if "content" in m]
+
+# the old way worked on text as the export wrote it, the new one on text read with its encoding fixed
+def bench_emoji(historyfile):
+    raw = contents(historyfile, repair=False)
+    texts = contents(historyfile)
+    report("emoji", len(texts),
+        lambda: [legacy_find_emoji(t) for t in raw],
+        lambda: [msgs.find_emoji(t) for t in texts])
+    same = sum(1 for r, t in zip(raw, texts) if legacy_find_emoji(r) == msgs.find_emoji(t))
+    print("\tsame emoji found in {} / {} messages (the rest have emoji sequences, or symbols that aren't emoji)".format(same, len(texts)))
+    return
+
+# reading a history and getting real unicode out of every message: fixing each string after parsing,
+# against fixing the raw text while it's parsed
+def bench_encoding(historyfile):
+    count = sum(1 for _ in msgs.iter_messages(historyfile, repair=False))
+    report("encoding", count,
+        lambda: [msgs.fix_history(m) for m in msgs.iter_messages(historyfile, repair=False)],
+        lambda: list(msgs.iter_messages(historyfile)))
+    return
+
+# word counting as it was: split on spaces, and four counter updates per word
+def legacy_count_words(content, ctr, pc):
+    for word in content.split(" "):
+        ctr["words"] += 1
+        ctr["words_use"][word] += 1
+        pc["words"] += 1
+        pc["words_use"][word] += 1
+    return
+
+# what messages.count_features does with a message's words now
+def count_words(content, ctr, pc):
+    words = msgs.TOKENIZER(content)
+    ctr["words"] += len(words)
+    ctr["words_use"].update(words)
+    pc["words"] += len(words)
+    pc["words_use"].update(words)
+    return
+
+def word_counts(texts, func):
+    ctr, pc = msgs.create_count(), msgs.create_count()
+    for t in texts:
+        func(t, ctr, pc)
+    return ctr
+
+# with no normalization, both count exactly the same words
+def bench_words(historyfile):
+    texts = contents(historyfile)
+    report("words", len(texts),
+        lambda: word_counts(texts, legacy_count_words),
+        lambda: word_counts(texts, count_words))
+    same = word_counts(texts, legacy_count_words)["words_use"] == word_counts(texts, count_words)["words_use"]
+    print("\tsame counts: {}".format(same))
+    return
+
+BENCHMARKS = {
+    "emoji": bench_emoji,
+    "encoding": bench_encoding,
+    "words": bench_words,
+}
+
+def main():
+    historyfile = sys.argv[1] if len(sys.argv) > 1 else msgs.TEST_FILE
+    names = sys.argv[2:] if len(sys.argv) > 2 else list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name](historyfile)
+    return
+
+if __name__ == '__main__':
+    main()
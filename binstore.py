@@ -0,0 +1,255 @@
+# compact binary file for a saved analysis, which can be read lazily:
+# nothing is decoded until a chart asks for it, and then only the bucket and field it asked for.
+#
+# layout:
+#   MAGIC
+#   records: one zlib-compressed json blob per (bucket, field group)
+#   index: json describing the dividers, their buckets and where each bucket's records are
+#   trailer: index offset and length, as two little-endian unsigned 64 bit ints
+#
+# a bucket's fields are split into groups: "scalars" (message counts, sentiment, ...) and one group
+# for each of messages.COUNTER_KEYS, each holding {"all": everyone's value, "per": {name: value}}.
+# so drawing message totals never decodes a words_use Counter.
+# a divider's most used items in each bucket (messages.TimeDivider.rank_top) are a record of their own too,
+# and so is its PrefixIndex if it was built: a json record of its names, and each array as a raw .npy record.
+import io, json, mmap, struct, zlib
+import numpy as np # https://www.numpy.org/
+from collections.abc import Mapping
+from datetime import datetime
+import messages as msgs
+
+MAGIC = b"MSTATS1\n"
+TRAILER = struct.Struct("<QQ")
+SCALARS = "scalars"
+INDEX_ARRAYS = ("starts", "counts", "sentiment")
+
+def save(td, filename):
+    dividers = td.dividers.values() if isinstance(td, msgs.MultiDivider) else [td]
+    index = {
+        "multi" : isinstance(td, msgs.MultiDivider),
+        "dividers" : [],
+    }
+    with open(filename, 'wb') as file:
+        file.write(MAGIC)
+        for divider in dividers:
+            entry = {
+                "period" : divider.period.value,
+                "latest_ms" : divider.latest_ms,
+                "tz" : divider.tz,
+                "settings" : divider.settings,
+                "index" : None,
+                "top" : None,
+                "buckets" : [],
+            }
+            if divider.index is not None:
+                entry["index"] = save_index(file, divider.index)
+            if divider.stored_top() is not None:
+                blob = zlib.compress(json.dumps(divider.top_serializable(), separators=(",", ":")).encode("utf-8"))
+                entry["top"] = (file.tell(), len(blob))
+                file.write(blob)
+            for key, trc in divider.trcounts.items():
+                bucket = {
+                    "key" : key.timestamp() if isinstance(key, datetime) else key,
+                    "fields" : {},
+                }
+                for group, value in split_groups(trc).items():
+                    blob = zlib.compress(json.dumps(value, separators=(",", ":"), default=msgs.encode_special).encode("utf-8"))
+                    bucket["fields"][group] = (file.tell(), len(blob))
+                    file.write(blob)
+                entry["buckets"].append(bucket)
+            index["dividers"].append(entry)
+
+        offset = file.tell()
+        blob = json.dumps(index, separators=(",", ":")).encode("utf-8")
+        file.write(blob)
+        file.write(TRAILER.pack(offset, len(blob)))
+    return
+
+# where each of an index's records went
+def save_index(file, index):
+    fields = {"meta": write_record(file, json.dumps({"keys": msgs.INDEX_KEYS, "names": index.names, "end": index.end}).encode("utf-8"))}
+    for name in INDEX_ARRAYS:
+        buf = io.BytesIO()
+        np.save(buf, getattr(index, name))
+        fields[name] = write_record(file, buf.getvalue())
+    return fields
+
+def write_record(file, data):
+    blob = zlib.compress(data)
+    field = (file.tell(), len(blob))
+    file.write(blob)
+    return field
+
+def split_groups(trc):
+    groups = {SCALARS: {"all": {}, "per": {}}}
+    for key in msgs.COUNTER_KEYS:
+        groups[key] = {"all": trc.allcount[key], "per": {}}
+    for key, value in trc.allcount.items():
+        if key not in msgs.COUNTER_KEYS:
+            groups[SCALARS]["all"][key] = value
+    for name, pcount in trc.percount.items():
+        groups[SCALARS]["per"][name] = {}
+        for key, value in pcount.items():
+            if key in msgs.COUNTER_KEYS:
+                groups[key]["per"][name] = value
+            else:
+                groups[SCALARS]["per"][name][key] = value
+    return groups
+
+def isbinary(filename):
+    with open(filename, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+# open a saved analysis without decoding any counts yet
+def load(filename):
+    reader = Reader(filename)
+    dividers = [LazyTimeDivider(reader, entry) for entry in reader.index["dividers"]]
+    if not reader.index["multi"]:
+        return dividers[0]
+    md = msgs.MultiDivider([])
+    for td in dividers:
+        md.dividers[td.period] = td
+        md.periods.append(td.period)
+    md.counted = list(md.dividers.values())
+    return md
+
+class Reader:
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a binary analysis".format(filename))
+        offset, length = TRAILER.unpack(self.data[-TRAILER.size:])
+        self.index = json.loads(self.data[offset:offset+length].decode("utf-8"))
+
+    def record(self, offset, length):
+        return json.loads(zlib.decompress(self.data[offset:offset+length]).decode("utf-8"), object_hook=msgs.decode_special)
+
+    def array(self, offset, length):
+        return np.load(io.BytesIO(zlib.decompress(self.data[offset:offset+length])))
+
+    # a PrefixIndex saved by save_index (or as one json record, as it used to be),
+    # or None if it was made with other INDEX_KEYS
+    def prefix_index(self, fields):
+        if not isinstance(fields, dict):
+            dct = self.record(*fields)
+            return msgs.PrefixIndex.decode(dct) if dct["keys"] == msgs.INDEX_KEYS else None
+        meta = self.record(*fields["meta"])
+        if meta["keys"] != msgs.INDEX_KEYS:
+            return None
+        arrays = {name: self.array(*fields[name]) for name in INDEX_ARRAYS}
+        return msgs.PrefixIndex(arrays["starts"], meta["end"], meta["names"], arrays["counts"], arrays["sentiment"])
+
+class LazyTimeDivider(msgs.TimeDivider):
+    def __init__(self, reader, entry):
+        self.period = msgs.TimePeriod(entry["period"])
+        self.latest_ms = entry["latest_ms"]
+        self.tz = entry.get("tz")
+        self.settings = entry.get("settings")
+        self.reader = reader
+        self.indexfield = entry.get("index")
+        self.index = None
+        self.topfield = entry.get("top")
+        self.top = None
+        self.trcounts = {}
+        for bucket in entry["buckets"]:
+            key = bucket["key"]
+            timerange = None
+            if key != msgs.TimeDivider.ALL_KEY:
+                key = self.todatetime(key * 1000)
+                timerange = self.getrange(key)
+            self.trcounts[key] = LazyTimeRangeCount(reader, bucket, timerange)
+
+    def prefix_index(self):
+        if self.index is None and self.indexfield is not None:
+            self.index = self.reader.prefix_index(self.indexfield)
+        return super().prefix_index()
+
+    def stored_top(self):
+        if self.top is None and self.topfield is not None:
+            self.top = self.decode_top(self.reader.record(*self.topfield))
+        return self.top
+
+    # decode everything into ordinary TimeRangeCounts, e.g. before adding to them
+    def materialize(self):
+        td = msgs.TimeDivider(self.period, self.tz)
+        td.settings = self.settings
+        td.latest_ms = self.latest_ms
+        td.index = self.prefix_index()
+        td.top = self.stored_top()
+        td.trcounts = {key: trc.materialize() for key, trc in self.trcounts.items()}
+        return td
+
+class LazyTimeRangeCount(msgs.TimeRangeCount):
+    def __init__(self, reader, bucket, timerange):
+        self.reader = reader
+        self.fields = bucket["fields"]
+        self.groups = {}
+        self.timerange = timerange
+        self._allcount = None
+        self._percount = None
+
+    def group(self, name):
+        if name not in self.groups:
+            self.groups[name] = self.reader.record(*self.fields[name])
+        return self.groups[name]
+
+    @property
+    def allcount(self):
+        if self._allcount is None:
+            self._allcount = LazyCount(self, None)
+        return self._allcount
+
+    @property
+    def percount(self):
+        if self._percount is None:
+            self._percount = {name: LazyCount(self, name) for name in self.group(SCALARS)["per"]}
+        return self._percount
+
+    def materialize(self):
+        trc = msgs.TimeRangeCount(self.timerange)
+        trc.allcount = msgs.counterify(self.allcount.materialize())
+        trc.percount = {name: msgs.counterify(pcount.materialize()) for name, pcount in self.percount.items()}
+        return trc
+
+# one count dict (everyone's, or one person's) of a lazily loaded bucket
+class LazyCount(Mapping):
+    def __init__(self, trc, name):
+        self.trc = trc
+        self.name = name
+        self.cache = {}
+
+    def __getitem__(self, key):
+        if key not in self.cache:
+            group = self.trc.group(key if key in msgs.COUNTER_KEYS else SCALARS)
+            if key in msgs.COUNTER_KEYS:
+                value = group["all"] if self.name is None else group["per"].get(self.name, {})
+                if not isinstance(value, msgs.TopCounter):
+                    value = msgs.Counter(value)
+            else:
+                value = (group["all"] if self.name is None else group["per"][self.name])[key]
+            self.cache[key] = value
+        return self.cache[key]
+
+    def __iter__(self):
+        scalars = self.trc.group(SCALARS)
+        yield from (scalars["all"] if self.name is None else scalars["per"][self.name])
+        yield from msgs.COUNTER_KEYS
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def materialize(self):
+        return {key: self[key] for key in self}
+
+# a fully decoded copy of a lazily loaded analysis
+def materialize(td):
+    if isinstance(td, msgs.MultiDivider):
+        md = msgs.MultiDivider([])
+        for period, divider in td.dividers.items():
+            md.dividers[period] = divider.materialize()
+            md.periods.append(period)
+        md.counted = list(md.dividers.values())
+        return md
+    return td.materialize()
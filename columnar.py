@@ -0,0 +1,296 @@
+#!./venv/bin/python3
+
+# convert a chat history into a columnar store: a directory of .npy arrays, one entry per message,
+# opened memory-mapped so that loading takes no time and processes reading the same store
+# share the OS page cache instead of each holding their own copy.
+#
+# strings (senders, stickers, photos, link domains, reactions) are interned into tables in meta.json,
+# and columns hold their ids. message text is kept in one utf-8 blob (content.bin), with each message's
+# [start, end) in content_offsets. messages with several photos / reactions use the same offsets scheme.
+# sentiment is scored once, when converting.
+import sys, os, json, argparse, urllib.parse
+from array import array
+import numpy as np # https://www.numpy.org/
+import messages as msgs
+
+STORE_VERSION = 1
+META_FILE = "meta.json"
+CONTENT_FILE = "content.bin"
+
+# message flags
+FLAG_STICKER = 1
+FLAG_PHOTOS = 2
+FLAG_SHARE = 4
+FLAG_CONTENT = 8
+KIND_FLAGS = (("sticker", FLAG_STICKER), ("photos", FLAG_PHOTOS), ("share", FLAG_SHARE))
+
+# name: (dtype, shape after the message count)
+COLUMNS = {
+    "timestamp_ms" : (np.int64, ()),      # -1 if missing
+    "sender" : (np.int32, ()),
+    "flags" : (np.uint8, ()),
+    "sticker" : (np.int32, ()),           # -1 if not a sticker
+    "share" : (np.int32, ()),             # link domain, -1 if none
+    "reactions" : (np.int32, ()),         # number of reactions
+    "sentiment" : (np.float64, (2,)),     # polarity, subjectivity (nan without content)
+    "content_offsets" : (np.int64, ()),   # one more than messages
+    "photo_offsets" : (np.int64, ()),     # one more than messages
+    "photos" : (np.int32, ()),
+    "react_offsets" : (np.int64, ()),     # one more than messages
+    "react_content" : (np.int32, ()),
+    "react_actor" : (np.int32, ()),       # ids in the "names" table
+}
+TABLES = ("names", "stickers", "photos", "domains", "reactions")
+
+# list of strings and the id of each
+class Interner:
+    def __init__(self):
+        self.ids = {}
+        self.items = []
+
+    def __call__(self, s):
+        if s not in self.ids:
+            self.ids[s] = len(self.items)
+            self.items.append(s)
+        return self.ids[s]
+
+def isstore(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, META_FILE))
+
+# write the messages of a history (file, thread directory or export zip) into a new store
+def convert(history, storedir, thread=None):
+    os.makedirs(storedir, exist_ok=True)
+    tables = {name: Interner() for name in TABLES}
+    cols = {name: array(np.dtype(dtype).char) for name, (dtype, _) in COLUMNS.items()}
+    for name in ("content_offsets", "photo_offsets", "react_offsets"):
+        cols[name].append(0)
+    header = {}
+    count = 0
+    contentsize = 0
+
+    with open(os.path.join(storedir, CONTENT_FILE), 'wb') as blob:
+        for shard in msgs.shards(msgs.iter_thread(history, header, thread=thread)):
+            if msgs.SENTIMENT_BACKEND == "batch":
+                msgs.prescore(shard)
+            for msg in shard:
+                cols["timestamp_ms"].append(msg.get("timestamp_ms", -1))
+                cols["sender"].append(tables["names"](msg.get("sender_name", "")))
+
+                flags = 0
+                for key, flag in KIND_FLAGS:
+                    if key in msg:
+                        flags |= flag
+
+                sticker = -1
+                if "sticker" in msg:
+                    sticker = tables["stickers"](msg["sticker"].get("uri", "unknown"))
+                cols["sticker"].append(sticker)
+
+                for phobj in msg.get("photos", []):
+                    cols["photos"].append(tables["photos"](phobj.get("uri", "unknown")))
+                cols["photo_offsets"].append(len(cols["photos"]))
+
+                share = -1
+                if "share" in msg and "link" in msg["share"]:
+                    share = tables["domains"](urllib.parse.urlparse(msg["share"]["link"]).netloc)
+                cols["share"].append(share)
+
+                if "content" in msg:
+                    flags |= FLAG_CONTENT
+                    data = msg["content"].encode("utf-8")
+                    blob.write(data)
+                    contentsize += len(data)
+                    cols["sentiment"].extend(msgs.message_sentiment(msg["content"]))
+                else:
+                    cols["sentiment"].extend((np.nan, np.nan))
+                cols["content_offsets"].append(contentsize)
+                cols["flags"].append(flags)
+
+                reactions = msg.get("reactions", [])
+                for react in reactions:
+                    cols["react_content"].append(tables["reactions"](react["reaction"]))
+                    cols["react_actor"].append(tables["names"](react["actor"]))
+                cols["reactions"].append(len(reactions))
+                cols["react_offsets"].append(len(cols["react_content"]))
+                count += 1
+            msgs.PRESCORED.clear()
+
+    for name, (dtype, shape) in COLUMNS.items():
+        np.save(os.path.join(storedir, name + ".npy"), np.frombuffer(cols[name], dtype=dtype).reshape((-1,) + shape))
+    with open(os.path.join(storedir, META_FILE), 'w') as file:
+        json.dump({
+            "version" : STORE_VERSION,
+            "count" : count,
+            "sentiment_backend" : msgs.SENTIMENT_BACKEND,
+            "header" : header,
+            "tables" : {name: tables[name].items for name in TABLES},
+        }, file)
+    return count
+
+class MessageStore:
+    def __init__(self, storedir):
+        self.storedir = storedir
+        with open(os.path.join(storedir, META_FILE), 'r') as file:
+            self.meta = json.load(file)
+        if self.meta["version"] != STORE_VERSION:
+            raise ValueError("{} is a version {} store, not {}".format(storedir, self.meta["version"], STORE_VERSION))
+        self.count = self.meta["count"]
+        self.header = self.meta["header"]
+        self.tables = self.meta["tables"]
+        self.columns = {}
+        self.blob = None
+
+    def __len__(self):
+        return self.count
+
+    # a column, memory-mapped the first time it's used
+    def __getitem__(self, name):
+        if name not in self.columns:
+            self.columns[name] = np.load(os.path.join(self.storedir, name + ".npy"), mmap_mode="r")
+        return self.columns[name]
+
+    def content(self, i):
+        if self.blob is None:
+            self.blob = np.memmap(os.path.join(self.storedir, CONTENT_FILE), dtype=np.uint8, mode="r") \
+                if os.path.getsize(os.path.join(self.storedir, CONTENT_FILE)) > 0 else np.zeros(0, dtype=np.uint8)
+        offsets = self["content_offsets"]
+        return bytes(self.blob[offsets[i]:offsets[i+1]]).decode("utf-8")
+
+    # what messages.extract_features would give for messages [start, stop), from the columns.
+    # with keep (a bool for each of them), only for the ones it keeps
+    def features(self, start, stop, keep=None):
+        names = self.tables["names"]
+        stickers = self.tables["stickers"]
+        photos = self.tables["photos"]
+        domains = self.tables["domains"]
+        reactions = self.tables["reactions"]
+        timestamp = self["timestamp_ms"][start:stop].tolist()
+        sender = self["sender"][start:stop].tolist()
+        flags = self["flags"][start:stop].tolist()
+        sticker = self["sticker"][start:stop].tolist()
+        share = self["share"][start:stop].tolist()
+        sentiment = self["sentiment"][start:stop].tolist()
+        photo_offsets = self["photo_offsets"][start:stop+1].tolist()
+        photo_ids = self["photos"]
+        react_offsets = self["react_offsets"][start:stop+1].tolist()
+        react_content = self["react_content"]
+        react_actor = self["react_actor"]
+
+        for j in range(stop - start):
+            if keep is not None and not keep[j]:
+                continue
+            feats = msgs.MessageFeatures()
+            feats.sender = names[sender[j]]
+            if timestamp[j] >= 0:
+                feats.timestamp_ms = timestamp[j]
+            feats.kinds = [key for key, flag in KIND_FLAGS if flags[j] & flag]
+            if sticker[j] >= 0:
+                feats.stickers.append(stickers[sticker[j]])
+            feats.photos = [photos[p] for p in photo_ids[photo_offsets[j]:photo_offsets[j+1]].tolist()]
+            if share[j] >= 0:
+                feats.shares.append(domains[share[j]])
+            if flags[j] & FLAG_CONTENT:
+                msgs.content_features(feats, self.content(start + j), msgs.Sentiment(*sentiment[j]))
+            r0, r1 = react_offsets[j], react_offsets[j+1]
+            feats.reactions = [(reactions[c], names[a]) for c, a in
+                zip(react_content[r0:r1].tolist(), react_actor[r0:r1].tolist())]
+            yield feats
+
+    # timestamps as floats, nan if missing (as TimeDivider.bucket_times takes them)
+    def timestamps(self, start=0, stop=None):
+        ts = self["timestamp_ms"][start:stop].astype(float)
+        ts[ts < 0] = np.nan
+        return ts
+
+# stores opened in this process
+OPEN_STORES = {}
+
+def open_store(storedir):
+    if storedir not in OPEN_STORES:
+        OPEN_STORES[storedir] = MessageStore(storedir)
+    return OPEN_STORES[storedir]
+
+# count messages [start, stop) of a store (only those sent after after_ms, unless it's None), for messages.analyze_shards
+def count_store_shard(shard, period, tz):
+    storedir, start, stop, after_ms = shard
+    store = open_store(storedir)
+    td = msgs.create_divider(period, tz)
+    timestamps = store.timestamps(start, stop)
+    if after_ms is None:
+        msgs.count_bucketed(td, store.features(start, stop), timestamps)
+        return (td, stop - start, None)
+    newer = timestamps > after_ms
+    msgs.count_bucketed(td, store.features(start, stop, newer), timestamps[newer])
+    return (td, int(newer.sum()), None)
+
+# analyze a store the same way messages.analyze_messages does a history.
+# pool workers each map the store themselves, so nothing but shard bounds is sent to them.
+# with after_ms, only messages sent after it are counted, and shards without any aren't read at all
+def analyze_store(storedir, period=msgs.TimePeriod.ALL, workers=1, after_ms=None, tz=msgs.TIMEZONE):
+    store = open_store(storedir)
+    shardlist = [(storedir, start, min(start + msgs.SHARD_SIZE, len(store)), after_ms)
+        for start in range(0, len(store), msgs.SHARD_SIZE)]
+    total = len(store)
+    if after_ms is not None:
+        newer = store.timestamps() > after_ms
+        shardlist = [shard for shard in shardlist if newer[shard[1]:shard[2]].any()]
+        total = int(newer.sum())
+    return msgs.analyze_shards(count_store_shard, shardlist, period, total=total, workers=workers, tz=tz)
+
+# messages.update_analysis for the messages of a store
+def update_store(td, storedir, workers=1):
+    return msgs.update_with(td, lambda periods, tz: analyze_store(storedir, periods, workers=workers, after_ms=td.latest_ms, tz=tz))
+
+# queries straight from the columns, for messages sent in [start, end) (datetimes, either can be None)
+
+def window(store, start=None, end=None):
+    ts = store["timestamp_ms"]
+    mask = ts >= 0
+    if start is not None:
+        mask &= ts >= start.timestamp() * 1000
+    if end is not None:
+        mask &= ts < end.timestamp() * 1000
+    return mask
+
+# {sender: total of weights (or number of messages)} over the messages in mask
+def per_sender(store, mask, weights=None):
+    names = store.tables["names"]
+    totals = np.bincount(store["sender"][mask], weights=None if weights is None else weights[mask], minlength=len(names))
+    return {names[i]: totals[i].item() for i in np.flatnonzero(totals)}
+
+def messages_per_sender(store, start=None, end=None, flag=None):
+    mask = window(store, start, end)
+    if flag is not None:
+        mask &= (store["flags"] & flag) != 0
+    return per_sender(store, mask)
+
+def reacts_received_per_sender(store, start=None, end=None):
+    return per_sender(store, window(store, start, end), store["reactions"])
+
+# {sender: (average polarity, average subjectivity)} of messages with content
+def sentiment_per_sender(store, start=None, end=None):
+    mask = window(store, start, end) & ((store["flags"] & FLAG_CONTENT) != 0)
+    counts = per_sender(store, mask)
+    polarity = per_sender(store, mask, store["sentiment"][:, 0])
+    subjectivity = per_sender(store, mask, store["sentiment"][:, 1])
+    return {name: (polarity.get(name, 0) / n, subjectivity.get(name, 0) / n) for name, n in counts.items()}
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="convert a chat history into a columnar store that messages.py can analyze")
+    parser.add_argument("history", help="chat history json, thread directory or export zip")
+    parser.add_argument("store", help="directory to write the store to")
+    parser.add_argument("--thread", metavar="NAME", help="which inbox thread of an export zip to convert")
+    parser.add_argument("--sentiment", choices=msgs.SENTIMENT_BACKENDS, default=msgs.SENTIMENT_BACKEND,
+        help="score each message with TextBlob, or many at once with batchsentiment (faster, very close)")
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args(sys.argv[1:])
+    msgs.SENTIMENT_BACKEND = args.sentiment
+    print("converting {} into {}".format(args.history, args.store))
+    count = convert(args.history, args.store, thread=args.thread)
+    print("stored {} messages".format(count))
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+#!./venv/bin/python3
+
+# an analysis held in a few numpy arrays, instead of a count dict (with seven Counters)
+# for every participant in every bucket, each keyed by full names, sticker uris, words, ...
+#
+# names and counted items are interned once into tables shared by every bucket of every divider.
+# each count (everyone's or one participant's, in one bucket) is a row, and a divider keeps:
+#   rows: the name id of each row (-1 for everyone's); a bucket's rows are [start, end), everyone's first
+#   scalars: rows x messages.INDEX_KEYS counts
+#   sentiment: rows x SENTIMENT_FIELDS (totals and summary sums, mins and maxes), and histogram bins
+#   one sparse counter per messages.COUNTER_KEYS: each row's [start, end) in parallel item / count arrays
+# so each bucket's arrays are slices of the divider's. anything that doesn't fit (TopCounters,
+# kept message sentiments) is kept as it is.
+#
+# count dicts are made from the arrays when they're asked for (trc.allcount, trc.percount[name]),
+# so code reading analyses works unchanged. they're read-only: materialize() before adding to one.
+# the compact form is a copy made of an analysis once it's counted or loaded: counting still builds
+# count dicts, and loading a json or sqlite analysis still decodes it whole before it's copied.
+# usage: ./compact.py analysis_filename  (prints how much memory the analysis takes both ways)
+import sys, gc, tracemalloc
+from collections import Counter
+from collections.abc import Mapping
+import numpy as np # https://www.numpy.org/
+import messages as msgs
+from columnar import Interner
+
+# the table each counter's items are interned into
+ITEM_TABLES = {
+    "reacts_received_use" : "reactions",
+    "reacts_given_use" : "reactions",
+    "sticker_use" : "stickers",
+    "photo_use" : "photos",
+    "share_use" : "domains",
+    "emoji_use" : "emoji",
+    "words_use" : "words",
+}
+TABLES = ("names",) + tuple(sorted(set(ITEM_TABLES.values())))
+# columns of the sentiment array: [polarity, subjectivity] of each
+SENTIMENT_FIELDS = ("total", "sum", "sumsq", "min", "max")
+# keys made from the arrays (in the order messages.create_count has them), anything else in a count is kept as it is
+ARRAY_KEYS = [key for key in msgs.create_count() if key != "sentiments"]
+
+class Tables:
+    def __init__(self):
+        self.interners = {name: Interner() for name in TABLES}
+
+    def __getitem__(self, name):
+        return self.interners[name]
+
+    def items(self, name):
+        return self.interners[name].items
+
+# a compact copy of an analysis (TimeDivider or MultiDivider)
+def compact(td, tables=None):
+    tables = Tables() if tables is None else tables
+    if isinstance(td, msgs.MultiDivider):
+        md = msgs.MultiDivider([])
+        for period, divider in td.dividers.items():
+            md.dividers[period] = CompactTimeDivider(divider, tables)
+            md.periods.append(period)
+        md.counted = list(md.dividers.values())
+        return md
+    return CompactTimeDivider(td, tables)
+
+# load a saved analysis of any format straight into compact form.
+# binary ones are decoded a bucket at a time, so the whole analysis never has to fit in memory as dicts
+def load(filename):
+    return compact(msgs.load_analysis(filename, lazy=True))
+
+# an analysis for reading: binary ones are left lazy, since only decoding the buckets and fields
+# that are read takes less than any copy of all of them; others are held in compact form
+def open_analysis(filename):
+    import binstore
+    if binstore.isbinary(filename):
+        return msgs.load_analysis(filename, lazy=True)
+    return load(filename)
+
+class CompactTimeDivider(msgs.TimeDivider):
+    def __init__(self, td, tables):
+        self.period = td.period
+        self.latest_ms = td.latest_ms
+        self.tz = td.tz
+        self.settings = td.settings
+        if td.index is None and getattr(td, "indexfield", None) is not None: # saved in a binary analysis, not read yet
+            td.prefix_index()
+        self.index = td.index
+        self.top = td.stored_top()
+        self.tables = tables
+        self.extra = {} # row: {key: value} of what isn't in the arrays
+
+        rows = []
+        scalars = []
+        sentiment = []
+        sentiment_n = []
+        hist = []
+        counters = {key: ([0], [], []) for key in msgs.COUNTER_KEYS}
+        self.trcounts = {}
+        for bucket, trc in td.trcounts.items():
+            start = len(rows)
+            names = list(trc.percount)
+            rows.append(-1)
+            rows.extend(tables["names"](name) for name in names)
+            for ctr in [trc.allcount] + [trc.percount[name] for name in names]:
+                row = len(scalars)
+                scalars.append([ctr.get(key, 0) for key in msgs.INDEX_KEYS])
+                summary = ctr["sentiment_summary"]
+                sentiment_n.append(summary["n"])
+                sentiment.append([ctr["sentiment_total"]] + [[np.nan if v is None else v for v in summary[field]] for field in SENTIMENT_FIELDS[1:]])
+                bins = [[0] * msgs.SENTIMENT_BINS, [0] * msgs.SENTIMENT_BINS]
+                for i in range(2):
+                    for b, n in summary["hist"][i].items():
+                        bins[i][int(b)] = n
+                hist.append(bins)
+                for key in msgs.COUNTER_KEYS:
+                    offsets, items, amounts = counters[key]
+                    if isinstance(ctr[key], msgs.TopCounter):
+                        self.extra.setdefault(row, {})[key] = ctr[key]
+                    else:
+                        table = tables[ITEM_TABLES[key]]
+                        for item, n in ctr[key].items():
+                            items.append(table(item))
+                            amounts.append(n)
+                    offsets.append(len(items))
+                for key, value in ctr.items():
+                    if key not in ARRAY_KEYS:
+                        self.extra.setdefault(row, {})[key] = value
+            self.trcounts[bucket] = CompactTimeRangeCount(self, trc.timerange, start, len(rows))
+
+        self.rows = np.array(rows, dtype=np.int32)
+        self.scalars = np.array(scalars, dtype=np.int64).reshape(len(rows), len(msgs.INDEX_KEYS))
+        self.sentiment = np.array(sentiment, dtype=np.float64).reshape(len(rows), len(SENTIMENT_FIELDS), 2)
+        self.sentiment_n = np.array(sentiment_n, dtype=np.int64)
+        self.hist = np.array(hist, dtype=np.int32).reshape(len(rows), 2, msgs.SENTIMENT_BINS)
+        self.counters = {key: (np.array(offsets, dtype=np.int64), np.array(items, dtype=np.int32), np.array(amounts, dtype=np.int64))
+            for key, (offsets, items, amounts) in counters.items()}
+
+    def prefix_index(self):
+        if self.index is None:
+            self.index = msgs.PrefixIndex.build(self)
+        return self.index
+
+    # ordinary dict-based counts, e.g. before adding to them
+    def materialize(self):
+        td = msgs.TimeDivider(self.period, self.tz)
+        td.settings = self.settings
+        td.latest_ms = self.latest_ms
+        td.index = self.index
+        td.top = self.top
+        td.trcounts = {key: trc.materialize() for key, trc in self.trcounts.items()}
+        return td
+
+    # the parts of a count dict, for one row
+    def scalar(self, row, key):
+        return self.scalars[row, msgs.INDEX_KEYS.index(key)].item()
+
+    def counter(self, row, key):
+        offsets, items, amounts = self.counters[key]
+        start, end = offsets[row], offsets[row + 1]
+        table = self.tables.items(ITEM_TABLES[key])
+        return Counter(dict(zip([table[i] for i in items[start:end].tolist()], amounts[start:end].tolist())))
+
+    # sums start out as ints and only become floats once a message's sentiment is added
+    def sentiment_pair(self, row, field):
+        if self.sentiment_n[row] == 0:
+            return [None, None] if field in ("min", "max") else [0, 0]
+        return self.sentiment[row, SENTIMENT_FIELDS.index(field)].tolist()
+
+    def sentiment_summary(self, row):
+        summary = {"n": self.sentiment_n[row].item()}
+        for field in SENTIMENT_FIELDS[1:]:
+            summary[field] = self.sentiment_pair(row, field)
+        summary["hist"] = [{str(b): self.hist[row, i, b].item() for b in np.flatnonzero(self.hist[row, i]).tolist()} for i in range(2)]
+        return summary
+
+# one bucket of a CompactTimeDivider: rows [start, end) of its arrays
+class CompactTimeRangeCount(msgs.TimeRangeCount):
+    def __init__(self, td, timerange, start, end):
+        self.td = td
+        self.timerange = timerange
+        self.start = start
+        self.end = end
+
+    @property
+    def allcount(self):
+        return CompactCount(self.td, self.start)
+
+    @property
+    def percount(self):
+        names = self.td.tables.items("names")
+        return {names[nameid]: CompactCount(self.td, self.start + 1 + i)
+            for i, nameid in enumerate(self.td.rows[self.start+1:self.end].tolist())}
+
+    def serializable(self):
+        return self.materialize().serializable()
+
+    # the entries are slices of the divider's counter arrays already, only their columns have to be found
+    def usage(self, usekey, mincount=1):
+        td = self.td
+        if any(usekey in td.extra.get(row, {}) for row in range(self.start, self.end)):
+            return super().usage(usekey, mincount)
+        offsets, items, amounts = td.counters[usekey]
+        entries = slice(offsets[self.start], offsets[self.end])
+        rows = np.repeat(np.arange(self.end - self.start), np.diff(offsets[self.start:self.end+1]))
+        itemids, counts = items[entries], amounts[entries]
+        everyone = rows == 0
+        kept = itemids[everyone][counts[everyone] >= mincount]
+        col = np.full(len(td.tables.items(ITEM_TABLES[usekey])), -1)
+        col[kept] = np.arange(len(kept))
+        cols = col[itemids]
+        used = cols != -1
+        names = td.tables.items("names")
+        table = td.tables.items(ITEM_TABLES[usekey])
+        return ([names[nameid] for nameid in td.rows[self.start+1:self.end].tolist()], [table[i] for i in kept.tolist()],
+            rows[used], cols[used], counts[used])
+
+    def merge(self, other):
+        raise TypeError("compact counts are read-only, materialize() them first")
+
+    def materialize(self):
+        trc = msgs.TimeRangeCount(self.timerange)
+        trc.allcount = self.allcount.materialize()
+        trc.percount = {name: pcount.materialize() for name, pcount in self.percount.items()}
+        return trc
+
+# one count dict (everyone's, or one person's) of a compact bucket, made as it's read
+class CompactCount(Mapping):
+    def __init__(self, td, row):
+        self.td = td
+        self.row = row
+
+    def __getitem__(self, key):
+        extra = self.td.extra.get(self.row, {})
+        if key in extra:
+            return extra[key]
+        if key in msgs.COUNTER_KEYS:
+            return self.td.counter(self.row, key)
+        if key in msgs.INDEX_KEYS:
+            return self.td.scalar(self.row, key)
+        if key == "sentiment_total":
+            return self.td.sentiment_pair(self.row, "total")
+        if key == "sentiment_summary":
+            return self.td.sentiment_summary(self.row)
+        raise KeyError(key)
+
+    def __iter__(self):
+        yield from ARRAY_KEYS
+        yield from (key for key in self.td.extra.get(self.row, {}) if key not in ARRAY_KEYS)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def materialize(self):
+        return {key: self[key] for key in self}
+
+# memory taken by building an object with make()
+def allocated(make):
+    tracemalloc.start()
+    obj = make()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, size
+
+def main():
+    filename = sys.argv[1] if len(sys.argv) > 1 else msgs.TEST_SAVE
+    _, dictsize = allocated(lambda: msgs.load_analysis(filename, lazy=False))
+    td, compactsize = allocated(lambda: load(filename))
+    buckets = sum(len(d.trcounts) for d in (td.dividers.values() if isinstance(td, msgs.MultiDivider) else [td]))
+    print("{}: {} buckets".format(filename, buckets))
+    print("\tdicts:   {:.1f} MB".format(dictsize / 1e6))
+    print("\tcompact: {:.1f} MB".format(compactsize / 1e6))
+    return
+
+if __name__ == '__main__':
+    main()
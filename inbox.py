@@ -0,0 +1,132 @@
+#!./venv/bin/python3
+
+# analyze every thread of a Facebook Messenger export at once.
+# an export's inbox/ directory has one directory per thread, each with message_1.json, message_2.json, ...
+# threads are analyzed in a process pool, biggest first so that the run doesn't end
+# waiting on one long thread, and each gets its own analysis file. every thread's counts
+# are also merged into one rollup, giving each participant's totals across all their threads.
+import sys, os, argparse, multiprocessing, zipfile
+import messages as msgs
+
+# the rollup goes in a directory of its own, which no thread's analysis (always name + extension) can be
+ROLLUP_DIR = "rollup"
+ROLLUP_NAME = "inbox"
+
+# a thread directory, or a thread inside an export zip (archive)
+class Thread:
+    def __init__(self, path, name, parts, size, archive=False):
+        self.path = path
+        self.name = name
+        self.parts = parts
+        self.size = size
+        self.archive = archive
+
+    def messages(self, header=None):
+        return msgs.iter_thread(self.path, header, thread=self.name if self.archive else None)
+
+# threads in an inbox directory or export zip, biggest first
+def find_threads(inbox):
+    threads = []
+    if zipfile.is_zipfile(inbox):
+        with zipfile.ZipFile(inbox) as zf:
+            for name, parts in msgs.archive_threads(inbox).items():
+                size = sum(zf.getinfo(part).file_size for part in parts)
+                threads.append(Thread(inbox, name, parts, size, archive=True))
+    else:
+        for entry in sorted(os.listdir(inbox)):
+            path = os.path.join(inbox, entry)
+            if os.path.isdir(path):
+                parts = msgs.part_files(path)
+                if parts:
+                    threads.append(Thread(path, entry, parts, sum(os.path.getsize(part) for part in parts)))
+    threads.sort(key=lambda t: t.size, reverse=True)
+    return threads
+
+# runs in a pool worker: analyze one thread and save its analysis
+def analyze_thread(thread, period, tz, outdir, extension):
+    header = {}
+    td = msgs.analyze_messages(thread.messages(header), period, tz=tz)
+    msgs.save_analysis(td, os.path.join(outdir, thread.name + extension))
+    return (thread, header.get("title", thread.name), td)
+
+def analyze_thread_args(args):
+    return analyze_thread(*args)
+
+# add other's counts into total (both for the same periods, finished)
+def merge_analysis(total, other):
+    if total is None:
+        return other
+    if isinstance(total, msgs.MultiDivider):
+        for period, td in total.dividers.items():
+            td.merge(other.dividers[period])
+        return total
+    return total.merge(other)
+
+def analyze_inbox(inbox, outdir, period=msgs.TimePeriod.ALL, workers=1, extension=".json", tz=msgs.TIMEZONE):
+    threads = find_threads(inbox)
+    print("{} threads in {}".format(len(threads), inbox))
+    os.makedirs(outdir, exist_ok=True)
+
+    tasks = [(thread, period, tz, outdir, extension) for thread in threads]
+    if workers <= 1:
+        results = map(analyze_thread_args, tasks)
+    else:
+        pool = multiprocessing.Pool(workers, initializer=msgs.apply_settings, initargs=(msgs.worker_settings(),))
+        results = pool.imap_unordered(analyze_thread_args, tasks)
+
+    rollup = None
+    for i, (thread, title, td) in enumerate(results):
+        print("[{}/{}] {}: {} messages".format(i+1, len(threads), title, td.alltime().allcount["msg"]))
+        rollup = merge_analysis(rollup, td)
+
+    if workers > 1:
+        pool.close()
+        pool.join()
+    if rollup is not None:
+        rollup.rank_top()
+    return rollup
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="analyze every chat thread in a Messenger export's inbox directory")
+    parser.add_argument("inbox", help="directory with one directory per thread, or the zip of a whole export")
+    parser.add_argument("outdir", help="where to save each thread's analysis and the rollup ({})".format(os.path.join(ROLLUP_DIR, ROLLUP_NAME)))
+    parser.add_argument("period", nargs="?", default=msgs.TimePeriod.MONTH.name.lower(),
+        help="(a)ll|(y)ear|(m)onth|(w)eek|(d)ay, or several separated by commas")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="threads to analyze at once")
+    parser.add_argument("--binary", action="store_true",
+        help="save analyses in the compact binary format ({})".format(msgs.BINARY_EXTENSION))
+    parser.add_argument("--sentiment", choices=msgs.SENTIMENT_BACKENDS, default=msgs.SENTIMENT_BACKEND,
+        help="score each message with TextBlob, or many at once with batchsentiment (faster, very close)")
+    parser.add_argument("--tz", type=msgs.timezone_name, default=msgs.TIMEZONE,
+        help="timezone to divide time periods in, e.g. Europe/London (default: this machine's local time)")
+    parser.add_argument("--topk", type=int, metavar="N",
+        help="only track about the N most used words and emoji in each count (approximate, constant memory)")
+    parser.add_argument("--words", type=msgs.tokenizer_option, default=msgs.TOKENIZER, metavar="NORMALIZATIONS",
+        help="how to normalize words before counting them, any of {} separated by commas".format(",".join(msgs.WORD_NORMALIZATIONS)))
+    args = parser.parse_intermixed_args(argv)
+    args.period = msgs.TimePeriod.parse_list(args.period)
+    if len(args.period) == 1:
+        args.period = args.period[0]
+    return args
+
+def main():
+    args = parse_args(sys.argv[1:])
+    msgs.SENTIMENT_BACKEND = args.sentiment
+    msgs.TOPK_CAPACITY = args.topk
+    msgs.TOKENIZER = args.words
+    extension = msgs.BINARY_EXTENSION if args.binary else ".json"
+
+    rollup = analyze_inbox(args.inbox, args.outdir, args.period, workers=args.workers, extension=extension, tz=args.tz)
+    if rollup is None:
+        print("no threads found")
+        return
+
+    os.makedirs(os.path.join(args.outdir, ROLLUP_DIR), exist_ok=True)
+    rollupfile = os.path.join(args.outdir, ROLLUP_DIR, ROLLUP_NAME + extension)
+    print("saving rollup of {} participants to {}".format(len(rollup.alltime().percount), rollupfile))
+    msgs.save_analysis(rollup, rollupfile)
+    print("saved to {}".format(rollupfile))
+    return
+
+if __name__ == '__main__':
+    main()
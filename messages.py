@@ -1,17 +1,37 @@
 #!./venv/bin/python3
 
 # perform some analysis on a downloaded Facebook Messenger chat history json
-import sys, json, unicodedata, urllib.parse
+import sys, os, io, re, json, zipfile, zoneinfo, heapq, unicodedata, urllib.parse, argparse, multiprocessing
 import numpy as np # https://www.numpy.org/
+try:
+    import scipy.sparse # https://scipy.org/ (optional: usage matrices are dense without it)
+except ImportError:
+    scipy = None
 from textblob import TextBlob # https://textblob.readthedocs.io/
-from collections import Counter, defaultdict
+import batchsentiment
+from collections import Counter, OrderedDict, defaultdict, namedtuple
 from datetime import datetime, timedelta
 from enum import Enum
 
 SPECIAL_TIMERANGE = "__timerange__"
 SPECIAL_TIMEDIVIDER = "__timedivider__"
+SPECIAL_MULTIDIVIDER = "__multidivider__"
+SPECIAL_TOPCOUNTER = "__topcounter__"
+BINARY_EXTENSION = ".mstats"
+SQLITE_EXTENSION = ".sqlite"
 
 EVERYONE_STICKER_KEY = "everyone"
+# counts kept in running totals by PrefixIndex, for querying any window of time
+INDEX_KEYS = [ "msg",
+               "sticker",
+               "photos",
+               "share",
+               "emoji",
+               "words",
+               "content",
+               "reacts_given",
+               "reacts_received_messages",
+               "reacts_received_total" ]
 COUNTER_KEYS = [ "reacts_received_use",
                  "reacts_given_use",
                  "sticker_use",
@@ -24,6 +44,86 @@ TEST_FILE = "bjork_message.json"
 TEST_SAVE = "bjork_analysis.json"
 TEST_PLACEHOLDER = "__test__"
 
+# one emoji grapheme cluster: a pictographic character (Unicode's Extended_Pictographic) or a keycap / regional
+# indicator flag / tag flag, optionally with a presentation selector and skin tone, and any more joined on with zero width
+# joiners. pictographs that are shown as text by default (©, ™, ❤, arrows, ...) only start an emoji with U+FE0F after them
+# (or a skin tone), so plain symbols in text aren't counted
+EMOJI_PRESENTATION = ("\u231a\u231b\u23e9-\u23ec\u23f0\u23f3\u25fd\u25fe\u2614\u2615\u2648-\u2653\u267f\u2693"
+    "\u26a1\u26aa\u26ab\u26bd\u26be\u26c4\u26c5\u26ce\u26d4\u26ea\u26f2\u26f3\u26f5\u26fa\u26fd\u2705\u270a\u270b"
+    "\u2728\u274c\u274e\u2753-\u2755\u2757\u2795-\u2797\u27b0\u27bf\u2b1b\u2b1c\u2b50\u2b55\U0001f004\U0001f0cf"
+    "\U0001f18e\U0001f191-\U0001f19a\U0001f201\U0001f21a\U0001f22f\U0001f232-\U0001f236\U0001f238-\U0001f23a"
+    "\U0001f250\U0001f251\U0001f300-\U0001f320\U0001f32d-\U0001f335\U0001f337-\U0001f37c\U0001f37e-\U0001f393"
+    "\U0001f3a0-\U0001f3ca\U0001f3cf-\U0001f3d3\U0001f3e0-\U0001f3f0\U0001f3f4\U0001f3f8-\U0001f3fa"
+    "\U0001f400-\U0001f43e\U0001f440\U0001f442-\U0001f4fc\U0001f4ff-\U0001f53d\U0001f54b-\U0001f54e"
+    "\U0001f550-\U0001f567\U0001f57a\U0001f595\U0001f596\U0001f5a4\U0001f5fb-\U0001f64f\U0001f680-\U0001f6c5"
+    "\U0001f6cc\U0001f6d0-\U0001f6d2\U0001f6d5-\U0001f6d9\U0001f6dc-\U0001f6df\U0001f6eb\U0001f6ec"
+    "\U0001f6f4-\U0001f6fc\U0001f7e0-\U0001f7eb\U0001f7f0\U0001f90c-\U0001f93a\U0001f93c-\U0001f945"
+    "\U0001f947-\U0001f9ff\U0001fa70-\U0001fa7c\U0001fa80-\U0001fac6\U0001fac8\U0001facc-\U0001fadd"
+    "\U0001fadf-\U0001faeb\U0001faef-\U0001fafa")
+EMOJI_TEXT_DEFAULT = ("\u00a9\u00ae\u203c\u2049\u2122\u2139\u2194-\u2199\u21a9\u21aa\u2328\u23cf\u23ed-\u23ef"
+    "\u23f1\u23f2\u23f8-\u23fa\u24c2\u25aa\u25ab\u25b6\u25c0\u25fb\u25fc\u2600-\u2604\u260e\u2611\u2618\u261d"
+    "\u2620\u2622\u2623\u2626\u262a\u262e\u262f\u2638-\u263a\u2640\u2642\u265f\u2660\u2663\u2665\u2666\u2668\u267b"
+    "\u267e\u2692\u2694-\u2697\u2699\u269b\u269c\u26a0\u26a7\u26b0\u26b1\u26c8\u26cf\u26d1\u26d3\u26e9\u26f0\u26f1"
+    "\u26f4\u26f7-\u26f9\u2702\u2708\u2709\u270c\u270d\u270f\u2712\u2714\u2716\u271d\u2721\u2733\u2734\u2744\u2747"
+    "\u2763\u2764\u27a1\u2934\u2935\u2b05-\u2b07\u3030\u303d\u3297\u3299\U0001f02c-\U0001f02f\U0001f094-\U0001f09f"
+    "\U0001f0af\U0001f0b0\U0001f0c0\U0001f0d0\U0001f0f6-\U0001f0ff\U0001f170\U0001f171\U0001f17e\U0001f17f"
+    "\U0001f1af-\U0001f1e5\U0001f202-\U0001f20f\U0001f237\U0001f23c-\U0001f23f\U0001f249-\U0001f24f"
+    "\U0001f252-\U0001f25f\U0001f266-\U0001f2ff\U0001f321\U0001f324-\U0001f32c\U0001f336\U0001f37d"
+    "\U0001f396\U0001f397\U0001f399-\U0001f39b\U0001f39e\U0001f39f\U0001f3cb-\U0001f3ce\U0001f3d4-\U0001f3df"
+    "\U0001f3f3\U0001f3f5\U0001f3f7\U0001f43f\U0001f441\U0001f4fd\U0001f549\U0001f54a\U0001f56f\U0001f570"
+    "\U0001f573-\U0001f579\U0001f587\U0001f58a-\U0001f58d\U0001f590\U0001f5a5\U0001f5a8\U0001f5b1\U0001f5b2"
+    "\U0001f5bc\U0001f5c2-\U0001f5c4\U0001f5d1-\U0001f5d3\U0001f5dc-\U0001f5de\U0001f5e1\U0001f5e3\U0001f5e8"
+    "\U0001f5ef\U0001f5f3\U0001f5fa\U0001f6cb\U0001f6cd-\U0001f6cf\U0001f6da\U0001f6db\U0001f6e0-\U0001f6e5"
+    "\U0001f6e9\U0001f6ed-\U0001f6f0\U0001f6f3\U0001f6fd-\U0001f6ff\U0001f7dc-\U0001f7df\U0001f7ec-\U0001f7ef"
+    "\U0001f80c-\U0001f80f\U0001f848-\U0001f84f\U0001f85a-\U0001f85f\U0001f888-\U0001f88f\U0001f8ae\U0001f8af"
+    "\U0001f8bc-\U0001f8bf\U0001f8c2-\U0001f8cf\U0001f8d9-\U0001f8ff\U0001fa58-\U0001fa5f\U0001fa6e\U0001fa6f"
+    "\U0001fa7d-\U0001fa7f\U0001fac7\U0001fac9-\U0001facb\U0001fade\U0001faec-\U0001faee\U0001fafb-\U0001faff"
+    "\U0001fc00-\U0001fffd")
+EMOJI_SKIN_TONE = "[\U0001f3fb-\U0001f3ff]"
+EMOJI_TAGS = "(?:[\U000e0020-\U000e007e]+\U000e007f)?"
+EMOJI_FIRST = ("(?:[" + EMOJI_PRESENTATION + "]\ufe0f?" + EMOJI_SKIN_TONE + "?"
+    "|[" + EMOJI_TEXT_DEFAULT + "](?:\ufe0f" + EMOJI_SKIN_TONE + "?|" + EMOJI_SKIN_TONE + "))" + EMOJI_TAGS)
+# after a joiner the sequence is already an emoji, so any pictograph continues it
+EMOJI_JOINED = "[" + EMOJI_PRESENTATION + EMOJI_TEXT_DEFAULT + "]\ufe0f?" + EMOJI_SKIN_TONE + "?" + EMOJI_TAGS
+RE_EMOJI = re.compile(
+    "[\U0001f1e6-\U0001f1ff]{2}"                  # flag
+    "|[0-9#*]\ufe0f?\u20e3"                       # keycap
+    "|" + EMOJI_FIRST + "(?:\u200d" + EMOJI_JOINED + ")*")
+RE_THREAD_PART = re.compile(r"message_(\d+)\.json")
+# a run of \u0080-\u00ff escapes, with all the backslashes before the first one
+# (an even number of them means it's an escaped backslash and plain text instead)
+RE_ESCAPES = re.compile(r"(\\+)(u00[89a-fA-F][0-9a-fA-F](?:\\u00[89a-fA-F][0-9a-fA-F])*)")
+ESCAPE_CHARS = frozenset("\\u0123456789abcdefABCDEF")
+# text at the end of a chunk that the next chunk might turn into (part of) such a run
+RE_ESCAPES_TAIL = re.compile(r"\\*(?:\\u00[89a-fA-F][0-9a-fA-F])*(?:\\(?:u(?:0(?:0(?:[89a-fA-F][0-9a-fA-F]?)?)?)?)?)?$")
+RE_ARCHIVE_PART = re.compile(r"(?:.*/)?messages/inbox/([^/]+)/message_(\d+)\.json")
+RE_URL = re.compile(r"(?:https?://|www\.)\S+")
+
+# ways words can be normalized before they're counted (see Tokenizer)
+WORD_NORMALIZATIONS = ("urls", "casefold", "punctuation", "stopwords")
+# stripped from both ends of each word
+PUNCTUATION = "!\"#$%&'()*+,-./:;<=>?@[\\]^_`{|}~\u00a1\u00ab\u00bb\u00bf\u2013\u2014\u2018\u2019\u201c\u201d\u2026"
+STOPWORDS = frozenset("""a about after all also am an and any are as at be because been but by can could did do does
+    don't for from had has have he her him his how i i'm if in into is it it's its just like me my no not of on or our
+    out she so that the their them then there they this to up us was we were what when which who will with would you
+    your""".split())
+
+STREAM_CHUNK_SIZE = 1 << 16     # characters read at a time when streaming a history file
+STREAM_PROGRESS_EVERY = 10000   # messages between progress lines when the total is unknown
+SHARD_SIZE = 2000               # messages counted into each partial result before merging
+SENTIMENT_CACHE_SIZE = 100000   # distinct message contents whose sentiment is remembered
+SENTIMENT_BINS = 20             # histogram bins over polarity [-1,1] and subjectivity [0,1]
+KEEP_SENTIMENTS = False         # also keep every message's sentiment in a "sentiments" list
+TOPK_KEYS = ("words_use", "emoji_use")  # counters that can be approximate
+TOPK_CAPACITY = None            # if set, TOPK_KEYS only track about this many top items per count
+TIMEZONE = None                 # default timezone name to divide time periods in (passed as tz), None for this machine's local time
+TOP_KEYS = ("words_use", "emoji_use", "sticker_use", "share_use") # counters whose most used items are kept ranked for charts
+TOP_COUNT = 100                 # how many of them, in each time period
+
+# "textblob" scores each message with TextBlob, "batch" scores each shard at once with batchsentiment
+SENTIMENT_BACKENDS = ("textblob", "batch")
+SENTIMENT_BACKEND = "textblob"
+
 class TimePeriod(Enum):
     ALL = 0
     YEAR = 1
@@ -71,85 +171,337 @@ class TimePeriod(Enum):
             return TimePeriod.DAY
         raise ValueError("{} could not be interpreted as a time period.".format(s))
 
-TEST_PERIOD = TimePeriod.MONTH
-
-# things to try still:
-# sentiment analysis
+    # comma separated, e.g. "y,m,d"
+    @staticmethod
+    def parse_list(s):
+        return [TimePeriod.parse(p) for p in s.split(",")]
 
-# cosine similarity of participants' sticker usage vectors
-def sticker_similarity(trc, mincount=3, excludeself=False):
-    stickers = []
-    names = [EVERYONE_STICKER_KEY]
-    usage = {}
+    # whether every time period of this length lies entirely within one period of the other length
+    # (days fit in weeks, months and years; weeks don't fit in months)
+    def nests_in(self, other):
+        if other == TimePeriod.ALL or other == self:
+            return True
+        if self == TimePeriod.DAY:
+            return True
+        if self == TimePeriod.MONTH:
+            return other == TimePeriod.YEAR
+        return False
 
-    for name in trc.percount:
-        names.append(name)
+TEST_PERIOD = TimePeriod.MONTH
 
-    for name in names:
-        usage[name] = [] # personal usage vector
+# same fields as TextBlob's, but picklable so that counts can be passed between processes
+Sentiment = namedtuple("Sentiment", ["polarity", "subjectivity"])
 
-    for stk, ct in trc.allcount["sticker_use"].items():
-        if ct < mincount:
-            continue
-        stickers.append(stk)
-        usage[EVERYONE_STICKER_KEY].append(ct)
-        for name in trc.percount:
-            if stk in trc.percount[name]["sticker_use"]:
-                usage[name].append(trc.percount[name]["sticker_use"][stk])
-            else:
-                usage[name].append(0)
-
-    print("{} stickers with usage over {}.".format(len(stickers), mincount))
-
-    similarity = [[0] * len(names) for _ in range(len(names))]
-    for i in range(len(similarity)):
-        for j in range(len(similarity[0])):
-            va = np.array(usage[names[i]])
-            vb = np.array(usage[names[j]])
-
-            if excludeself:
-                if names[i] == EVERYONE_STICKER_KEY and names[j] == EVERYONE_STICKER_KEY:
-                    va, vb = va - vb, vb - va 
-                elif names[i] == EVERYONE_STICKER_KEY:
-                    va = va - vb
-                elif names[j] == EVERYONE_STICKER_KEY:
-                    vb = vb - va
-
-            va = (va / np.linalg.norm(va) if np.linalg.norm(va) != 0 else va)
-            vb = (vb / np.linalg.norm(vb) if np.linalg.norm(vb) != 0 else vb)
-            divisor = (np.linalg.norm(va) * np.linalg.norm(vb))
-            if divisor == 0:
-                divisor = 1
-            similarity[i][j] = np.dot(va, vb) / divisor
+# things to try still:
+# sentiment analysis
 
+# everyone's and each participant's use of the items of a counter (one of COUNTER_KEYS) with at least
+# mincount uses in total, as a matrix with everyone's row first: sparse with scipy, or else dense
+def usage_matrix(trc, usekey, mincount=1):
+    names, items, rows, cols, counts = trc.usage(usekey, mincount)
+    shape = (len(names) + 1, len(items))
+    if scipy is None:
+        usage = np.zeros(shape)
+        usage[rows, cols] = counts
+    else:
+        usage = scipy.sparse.csr_matrix((counts.astype(np.float64), (rows, cols)), shape=shape)
+    return names, items, usage
+
+# cosine similarity of participants' usage vectors of a counter, all from one product of the usage matrix with itself.
+# with excludeself, everyone's row and column compare each participant with everyone else (everyone's use less theirs)
+def usage_similarity(trc, usekey, mincount=3, excludeself=False):
+    names, items, usage = usage_matrix(trc, usekey, mincount)
+    print("{} {} items with usage over {}.".format(len(items), usekey, mincount))
+
+    gram = usage @ usage.T
+    gram = gram.toarray() if scipy is not None else gram
+    sumsq = gram.diagonal().copy()
+    norms = np.sqrt(sumsq)
+    divisor = np.outer(norms, norms)
+    similarity = np.divide(gram, divisor, out=np.zeros_like(gram), where=divisor != 0)
     if excludeself:
-        names[0] += " else"
+        # (everyone - p) . p and |everyone - p|^2, from everyone's and p's row of the product
+        dots = gram[0] - sumsq
+        divisor = np.sqrt(sumsq[0] - 2 * gram[0] + sumsq) * norms
+        others = np.divide(dots, divisor, out=np.zeros_like(dots), where=divisor != 0)
+        others[0] = 0
+        similarity[0, :] = others
+        similarity[:, 0] = others
+
+    names = [EVERYONE_STICKER_KEY + (" else" if excludeself else "")] + names
+    return (names, similarity, items, usage)
 
-    return (names, similarity, stickers, usage)
+# cosine similarity of participants' sticker usage vectors
+def sticker_similarity(trc, mincount=3, excludeself=False):
+    return usage_similarity(trc, "sticker_use", mincount=mincount, excludeself=excludeself)
 
 def counterify(dct):
     for key in COUNTER_KEYS:
-        dct[key] = Counter(dct[key])
+        if not isinstance(dct[key], TopCounter):
+            dct[key] = Counter(dct[key])
+    # analyses from before sentiment summaries
+    if "sentiment_summary" not in dct:
+        dct["sentiment_summary"] = create_sentiment_summary()
+        for sentiment in dct.get("sentiments", []):
+            add_sentiment(dct["sentiment_summary"], Sentiment(*sentiment))
     return dct
 
-def loadjson(filename):
-    def decoder(dct):
-        if SPECIAL_TIMERANGE in dct:
-            return TimeRangeCount.decode(dct)
-        if SPECIAL_TIMEDIVIDER in dct:
-            return TimeDivider.decode(dct)
-        return dct
+# for objects saved by encode_special
+def decode_special(dct):
+    if SPECIAL_TIMERANGE in dct:
+        return TimeRangeCount.decode(dct)
+    if SPECIAL_TIMEDIVIDER in dct:
+        return TimeDivider.decode(dct)
+    if SPECIAL_MULTIDIVIDER in dct:
+        return MultiDivider.decode(dct)
+    if SPECIAL_TOPCOUNTER in dct:
+        return TopCounter.decode(dct)
+    return dct
 
+# with repair, the text is fixed as a chat history's is while streaming (see fix_escapes) before it's parsed.
+# only for histories: analyses hold text that's fixed already, which fixing again could change
+def loadjson(filename, repair=False):
     with open(filename, 'r') as file:
-        return json.load(file, object_hook=decoder)
+        if repair:
+            return json.loads(fix_escapes(file.read()), object_hook=decode_special)
+        return json.load(file, object_hook=decode_special)
     return None
 
+# load an analysis saved by save_analysis, in any format.
+# binary analyses are read lazily unless lazy is False (needed to add to them)
+def load_analysis(filename, lazy=True):
+    import binstore, sqlitestore
+    if binstore.isbinary(filename):
+        td = binstore.load(filename)
+        return td if lazy else binstore.materialize(td)
+    if sqlitestore.isdatabase(filename):
+        return sqlitestore.load(filename)
+    return loadjson(filename)
+
+# save an analysis as json, in the compact binary format if filename ends in BINARY_EXTENSION,
+# or into a SQLite database if it ends in SQLITE_EXTENSION
+def save_analysis(td, filename):
+    if filename.endswith(BINARY_EXTENSION):
+        import binstore
+        binstore.save(td, filename)
+    elif filename.endswith(SQLITE_EXTENSION):
+        import sqlitestore
+        sqlitestore.save(td, filename)
+    else:
+        savejson(td.serializable(), filename)
+    return
+
+# incrementally parse a chat history json, yielding one message dict at a time
+# without ever holding the whole "messages" array in memory.
+# other top-level fields (participants, title, ...) are collected into header if given.
+def iter_messages(filename, header=None, chunksize=STREAM_CHUNK_SIZE, repair=True):
+    with open(filename, 'r') as file:
+        yield from iter_messages_fp(file, header, chunksize, repair)
+
+# a thread in a Messenger export is a directory split into message_1.json, message_2.json, ...
+# the files of a thread directory in order, or just the file itself if given one
+def thread_parts(path):
+    if not os.path.isdir(path):
+        return [path]
+    parts = part_files(path)
+    if not parts:
+        raise ValueError("{} has no message_N.json files".format(path))
+    return parts
+
+# the message_N.json files in a directory in order, if there are any
+def part_files(path):
+    parts = []
+    for entry in os.listdir(path):
+        match = RE_THREAD_PART.fullmatch(entry)
+        if match:
+            parts.append((int(match.group(1)), os.path.join(path, entry)))
+    return [filename for _, filename in sorted(parts)]
+
+# messages from every part of a thread, one file after another.
+# path can also be the zip of a whole export, read without extracting it;
+# thread then names which of its inbox threads to read (unless there is only one)
+def iter_thread(path, header=None, chunksize=STREAM_CHUNK_SIZE, thread=None):
+    if zipfile.is_zipfile(path):
+        yield from iter_archive_thread(path, thread, header, chunksize)
+        return
+    for filename in thread_parts(path):
+        yield from iter_messages(filename, header, chunksize)
+
+# {thread name: its message_N.json members in order} for the inbox of an export zip.
+# photos, videos, ... in the archive are never read
+def archive_threads(archive):
+    threads = defaultdict(list)
+    with zipfile.ZipFile(archive) as zf:
+        for member in zf.namelist():
+            match = RE_ARCHIVE_PART.fullmatch(member)
+            if match:
+                threads[match.group(1)].append((int(match.group(2)), member))
+    return {name: [member for _, member in sorted(parts)] for name, parts in threads.items()}
+
+def iter_archive_thread(archive, thread=None, header=None, chunksize=STREAM_CHUNK_SIZE):
+    threads = archive_threads(archive)
+    if thread is None:
+        if len(threads) != 1:
+            raise ValueError("{} has {} threads, pick one with --thread (or use inbox.py for all)".format(archive, len(threads)))
+        thread = next(iter(threads))
+    if thread not in threads:
+        raise ValueError("no thread {} in {}".format(thread, archive))
+    with zipfile.ZipFile(archive) as zf:
+        for member in threads[thread]:
+            with zf.open(member) as raw:
+                yield from iter_messages_fp(io.TextIOWrapper(raw, encoding="utf-8"), header, chunksize)
+
+# unless repair is False, the export's mojibake is fixed in the raw text as it's read (see fix_escapes),
+# so every string comes out as real unicode
+def iter_messages_fp(file, header=None, chunksize=STREAM_CHUNK_SIZE, repair=True):
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    held = "" # end of the text read so far, that an escape sequence cut off by the chunk may continue
+
+    # make sure buf has something past pos (reading more if needed); False at end of file
+    def fill():
+        nonlocal buf, pos, eof
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf) or eof:
+                return pos < len(buf)
+            more()
+
+    def more():
+        nonlocal buf, pos, eof, held
+        chunk = file.read(chunksize)
+        if not chunk:
+            eof = True
+        if repair:
+            text = held + chunk
+            cut = len(text) if eof else escapes_tail(text)
+            chunk, held = fix_escapes(text[:cut]), text[cut:]
+        # drop what has already been consumed so the buffer stays small
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    # decode one complete json value at pos, reading more of the file until it fits
+    def value():
+        nonlocal pos
+        while True:
+            fill()
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+                # a value running up to the end of the buffer (a number) may have been cut short
+                if eof or (end < len(buf) and buf[end] in " \t\r\n,:]}"):
+                    pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            more()
+
+    # next non-whitespace character, without consuming it
+    def peek():
+        if not fill():
+            raise ValueError("malformed chat history: unexpected end of file")
+        return buf[pos]
+
+    def expect(ch):
+        nonlocal pos
+        if peek() != ch:
+            raise ValueError("malformed chat history: expected '{}', found '{}'".format(ch, buf[pos]))
+        pos += 1
+
+    expect("{")
+    if peek() == "}":
+        return
+    while True:
+        key = value()
+        expect(":")
+        if key == "messages":
+            expect("[")
+            if peek() == "]":
+                pos += 1
+            else:
+                while True:
+                    yield value()
+                    if peek() == "]":
+                        pos += 1
+                        break
+                    expect(",")
+        else:
+            val = value()
+            if header is not None:
+                header[key] = val
+        if peek() == "}":
+            return
+        expect(",")
+
+# Messenger exports write text as utf-8 bytes, each escaped as its own character: "\\u00f0\\u009f\\u0098\\u0080" for 😀.
+# this decodes every run of such escapes in raw json text into the characters they spell, before the json
+# is parsed, so that no string ever needs fixing afterwards. runs that aren't valid utf-8 are left alone
+def fix_escapes(text):
+    return RE_ESCAPES.sub(fix_escapes_match, text)
+
+def fix_escapes_match(match):
+    backslashes, escapes = match.groups()
+    if len(backslashes) % 2 == 0: # an escaped backslash then "u00.." as text, maybe followed by escapes
+        return backslashes + escapes[:5] + fix_escapes(escapes[5:])
+    try:
+        return backslashes[:-1] + bytes.fromhex(escapes.replace("u00", "").replace("\\", "")).decode("utf-8")
+    except UnicodeDecodeError:
+        return match.group(0)
+
+# where the text that a chunk ending text might continue (see RE_ESCAPES_TAIL) starts.
+# only the end of text is searched, from somewhere that can't be inside a run of escapes
+def escapes_tail(text):
+    start = max(0, len(text) - 64)
+    while start > 0 and text[start - 1] in ESCAPE_CHARS:
+        start -= 1
+    return RE_ESCAPES_TAIL.search(text, start).start()
+
+# fix the encoding of every string in a history loaded without repairing it (see fix_escapes).
+# it's not idempotent (text that's fixed already can change again), so histories are repaired once as they're
+# read instead (iter_messages, loadjson(repair=True)); this is only for comparing with that
+def fix_history(obj):
+    if isinstance(obj, str):
+        return fix_encoding(obj)
+    if isinstance(obj, list):
+        return [fix_history(v) for v in obj]
+    if isinstance(obj, dict):
+        return {fix_history(k): fix_history(v) for k, v in obj.items()}
+    return obj
+
 def savejson(obj, filename):
     obj["__special__"] = True
     with open(filename, 'w') as file:
-        json.dump(obj, file, indent=2)
+        json.dump(obj, file, indent=2, default=encode_special)
     return
 
+# for objects json doesn't know how to write
+def encode_special(obj):
+    if hasattr(obj, "serializable"):
+        return obj.serializable()
+    raise TypeError("{} can't be saved as json".format(type(obj).__name__))
+
+# add counts from other into ctr
+def merge_count(ctr, other):
+    for key, val in other.items():
+        if key in COUNTER_KEYS:
+            if isinstance(val, TopCounter) and not isinstance(ctr[key], TopCounter):
+                ctr[key] = TopCounter(val.capacity).update(ctr[key])
+            ctr[key].update(val)
+        elif key == "sentiment_total":
+            ctr[key][0] += val[0]
+            ctr[key][1] += val[1]
+        elif key == "sentiments":
+            if key in ctr:
+                ctr[key].extend(val)
+        elif key == "sentiment_summary":
+            merge_sentiment_summary(ctr[key], val)
+        else:
+            ctr[key] += val
+    return ctr
+
 def create_count():
     ctr = {
             "msg" : 0,
@@ -175,11 +527,144 @@ def create_count():
 
     ctr["emoji_use"] = Counter()
     ctr["words_use"] = Counter()
+    if TOPK_CAPACITY:
+        for key in TOPK_KEYS:
+            ctr[key] = TopCounter(TOPK_CAPACITY)
 
-    ctr["sentiments"] = []
+    ctr["sentiment_summary"] = create_sentiment_summary()
+    if KEEP_SENTIMENTS:
+        ctr["sentiments"] = []
 
     return ctr
 
+# approximate Counter for the most common items, using a fixed amount of memory (Space-Saving).
+# at most capacity items are tracked; when a new item comes in while full, the least common one
+# is replaced and the new item inherits its count. so counts can be too high, but never by more than
+# errors[item] <= error_bound() <= total / capacity, and any item used more often than that is kept.
+class TopCounter:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}    # how much each count may be over by (only kept when not 0)
+        self.total = 0
+        self.heap = []      # (count, item), with old entries left in until they come up
+
+    @staticmethod
+    def decode(dct):
+        tc = TopCounter(dct["capacity"])
+        tc.counts = dct["counts"]
+        tc.errors = dct["errors"]
+        tc.total = dct["total"]
+        tc.heap = [(c, item) for item, c in tc.counts.items()]
+        heapq.heapify(tc.heap)
+        return tc
+
+    def serializable(self):
+        s = {}
+        s[SPECIAL_TOPCOUNTER] = True
+        s["capacity"] = self.capacity
+        s["total"] = self.total
+        s["counts"] = self.counts
+        s["errors"] = self.errors
+        return s
+
+    def add(self, item, n=1):
+        self.total += n
+        counts = self.counts
+        if item in counts:
+            counts[item] += n
+        elif len(counts) < self.capacity:
+            counts[item] = n
+        else:
+            low = self.popmin()
+            counts[item] = low + n
+            if low:
+                self.errors[item] = low
+        heapq.heappush(self.heap, (counts[item], item))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(c, it) for it, c in counts.items()]
+            heapq.heapify(self.heap)
+        return
+
+    # drop the least common item, returning its count
+    def popmin(self):
+        while True:
+            c, item = heapq.heappop(self.heap)
+            if self.counts.get(item) == c:
+                del self.counts[item]
+                self.errors.pop(item, None)
+                return c
+
+    # the count any untracked item could have
+    def floor(self):
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.values())
+
+    def error_bound(self):
+        return max(self.errors.values(), default=0)
+
+    # like Counter.update: count each item of an iterable, or add counts from a mapping / TopCounter
+    def update(self, other):
+        if isinstance(other, TopCounter):
+            return self.merge(other)
+        if hasattr(other, "items"):
+            for item, n in other.items():
+                self.add(item, n)
+        else:
+            for item in other:
+                self.add(item)
+        return self
+
+    # combine two summaries, keeping the capacity most common (mergeable Space-Saving):
+    # an item missing from one side could have had up to that side's floor() there
+    def merge(self, other):
+        lowa = self.floor()
+        lowb = other.floor()
+        combined = {}
+        for item in self.counts.keys() | other.counts.keys():
+            count = self.counts.get(item, lowa) + other.counts.get(item, lowb)
+            error = (self.errors.get(item, 0) if item in self.counts else lowa) + \
+                (other.errors.get(item, 0) if item in other.counts else lowb)
+            combined[item] = (count, error)
+        keep = heapq.nlargest(self.capacity, combined.items(), key=lambda kv: (kv[1][0], kv[0]))
+        self.counts = {item: ce[0] for item, ce in keep}
+        self.errors = {item: ce[1] for item, ce in keep if ce[1]}
+        self.total += other.total
+        self.heap = [(c, item) for item, c in self.counts.items()]
+        heapq.heapify(self.heap)
+        return self
+
+    def __getitem__(self, item):
+        return self.counts.get(item, 0)
+
+    # ctr[item] += n
+    def __setitem__(self, item, value):
+        self.add(item, value - self.counts.get(item, 0))
+
+    def __contains__(self, item):
+        return item in self.counts
+
+    def __iter__(self):
+        return iter(self.counts)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def items(self):
+        return self.counts.items()
+
+    def keys(self):
+        return self.counts.keys()
+
+    def values(self):
+        return self.counts.values()
+
+    def most_common(self, n=None):
+        if n is None:
+            return sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)
+        return heapq.nlargest(n, self.counts.items(), key=lambda kv: kv[1])
+
 class TimeRangeCount:
     def __init__(self, timerange=None):
         self.timerange = timerange
@@ -211,6 +696,30 @@ class TimeRangeCount:
         s["percount"] = self.percount
         return s
 
+    # (names, items, rows, cols, counts): the items of usekey used at least mincount times in all, and the entries of
+    # a matrix of their use, with row 0 for everyone and then one for each of names
+    def usage(self, usekey, mincount=1):
+        names = list(self.percount)
+        items = [item for item, n in self.allcount[usekey].items() if n >= mincount]
+        col = {item: i for i, item in enumerate(items)}
+        rows, cols, counts = [], [], []
+        for row, ctr in enumerate([self.allcount] + [self.percount[name] for name in names]):
+            for item, n in ctr[usekey].items():
+                if item in col:
+                    rows.append(row)
+                    cols.append(col[item])
+                    counts.append(n)
+        return names, items, np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64), np.array(counts, dtype=np.int64)
+
+    # add all counts from another TimeRangeCount into this one
+    def merge(self, other):
+        merge_count(self.allcount, other.allcount)
+        for name, pcount in other.percount.items():
+            if name not in self.percount:
+                self.percount[name] = create_count()
+            merge_count(self.percount[name], pcount)
+        return self
+
     def rangestr(self):
         if self.timerange is None:
             return "all time"
@@ -222,37 +731,51 @@ class TimeRangeCount:
         return dt >= self.timerange[0] and dt < self.timerange[1]
 
     def message(self, msg):
-        if self.timerange != None and "timestamp_ms" in msg:
-            msg_dt = datetime.fromtimestamp(msg["timestamp_ms"]/1000.0)
-            if not self.inrange(msg_dt):
+        self.count(extract_features(msg))
+
+    # count an already-extracted message
+    def count(self, feats):
+        # (a TimeDivider has already picked this range for the message)
+        if self.timerange != None and feats.timekey is None and feats.timestamp_ms is not None:
+            if not self.inrange(datetime.fromtimestamp(feats.timestamp_ms/1000.0, self.timerange[0].tzinfo)):
                 print("message not in time range ({} to {})".format(self.timerange[0], self.timerange[1]))
                 return
 
         # count things
-        count_message(msg, self.allcount, self.percount)
+        count_features(feats, self.allcount, self.percount)
 
         # tally reactions
-        count_reacts(msg, self.allcount, self.percount)
+        count_feature_reacts(feats, self.allcount, self.percount)
 
 class TimeDivider:
     ALL_KEY = "TimeDivider_ALLKEY"
 
-    def __init__(self, period=TimePeriod.ALL):
+    def __init__(self, period=TimePeriod.ALL, tz=None):
         self.trcounts = {}
         self.period = period
         if self.period not in TimePeriod:
             print("! invalid period")
         self.trcounts[TimeDivider.ALL_KEY] = TimeRangeCount()
+        self.latest_ms = None # timestamp of the newest message counted
+        self.tz = tz # timezone name periods start and end in (e.g. "Europe/London"), None for this machine's
+        self.settings = counting_settings() # how words, top-k counters and sentiment were counted, None if not known
+        self.index = None # PrefixIndex of the counts, built when asked for (only ever saved in binary analyses)
+        self.top = None # {usekey: {bucket key: [(item, count), ...]}}, see rank_top
 
     @staticmethod
     def decode(dct):
-        td = TimeDivider(TimePeriod(dct["period"]))
+        td = TimeDivider(TimePeriod(dct["period"]), dct.get("tz"))
+        td.latest_ms = dct.get("latest_ms")
+        td.settings = dct.get("settings")
+        td.top = td.decode_top(dct.get("top"))
         trcs = {}
         for timestamp in dct["trcounts"]:
             if timestamp == TimeDivider.ALL_KEY:
                 trcs[timestamp] = dct["trcounts"][timestamp]
             else:
-                trcs[datetime.fromtimestamp(float(timestamp))] = dct["trcounts"][timestamp]
+                key = td.todatetime(float(timestamp) * 1000)
+                trcs[key] = dct["trcounts"][timestamp]
+                trcs[key].timerange = td.getrange(key)
         td.trcounts = trcs
         return td
 
@@ -266,8 +789,19 @@ class TimeDivider:
             else:
                 s["trcounts"][k] = self.trcounts[k].serializable()
         s["period"] = self.period.value
+        s["latest_ms"] = self.latest_ms
+        s["tz"] = self.tz
+        s["settings"] = self.settings
+        s["top"] = self.top_serializable()
         return s
 
+    @property
+    def zone(self):
+        return None if self.tz is None else zoneinfo.ZoneInfo(self.tz)
+
+    def todatetime(self, timestamp_ms):
+        return datetime.fromtimestamp(timestamp_ms/1000.0, self.zone)
+
     def alltime(self):
         return self.trcounts[TimeDivider.ALL_KEY]
 
@@ -277,29 +811,38 @@ class TimeDivider:
         return sorted(keys)
 
     def message(self, msg):
-        self.trcounts[TimeDivider.ALL_KEY].message(msg)
+        self.count(extract_features(msg))
 
-        if self.period != TimePeriod.ALL:
-            msg_dt = None if "timestamp_ms" not in msg else datetime.fromtimestamp(msg["timestamp_ms"]/1000.0)
-            timekey = self.getkey(msg_dt)
+    # count an already-extracted message into the all-time and time period counts.
+    # timekey is the message's key if it's already known (see bucket_times)
+    def count(self, feats, timekey=None):
+        self.trcounts[TimeDivider.ALL_KEY].count(feats)
+        self.latest_ms = later(self.latest_ms, feats.timestamp_ms)
+        self.index = None
+        self.top = None
 
-            if timekey not in self.trcounts:
-                self.trcounts[timekey] = self.createtrcount(timekey)
-            self.trcounts[timekey].message(msg)
+        if self.period != TimePeriod.ALL and feats.timestamp_ms is not None:
+            if timekey is None:
+                timekey = self.getkey(self.todatetime(feats.timestamp_ms))
+            feats.timekey = timekey
+
+            if feats.timekey not in self.trcounts:
+                self.trcounts[feats.timekey] = self.createtrcount(feats.timekey)
+            self.trcounts[feats.timekey].count(feats)
 
     # a datetime representing the start of a time period to be counted for
     def getkey(self, dt):
         if self.period is TimePeriod.ALL:
             return TimeDivider.ALL_KEY
         elif self.period is TimePeriod.YEAR:
-            return datetime(year=dt.year, month=1, day=1)
+            return datetime(year=dt.year, month=1, day=1, tzinfo=dt.tzinfo)
         elif self.period is TimePeriod.MONTH:
-            return datetime(year=dt.year, month=dt.month, day=1)
+            return datetime(year=dt.year, month=dt.month, day=1, tzinfo=dt.tzinfo)
         elif self.period is TimePeriod.WEEK:
             pdt = dt - timedelta(days=dt.weekday())
-            return datetime(year=pdt.year, month=pdt.month, day=pdt.day) # key using first day of week
+            return datetime(year=pdt.year, month=pdt.month, day=pdt.day, tzinfo=dt.tzinfo) # key using first day of week
         elif self.period is TimePeriod.DAY:
-            return datetime(year=dt.year, month=dt.month, day=dt.day)
+            return datetime(year=dt.year, month=dt.month, day=dt.day, tzinfo=dt.tzinfo)
         return None
 
     # a datetime tuple with the start and end of a time period to be counted
@@ -307,11 +850,11 @@ class TimeDivider:
         if self.period is TimePeriod.ALL:
             return None
         elif self.period is TimePeriod.YEAR:
-            return (key, datetime(year=key.year+1, month=1, day=1))
+            return (key, datetime(year=key.year+1, month=1, day=1, tzinfo=key.tzinfo))
         elif self.period is TimePeriod.MONTH:
             if key.month == 12:
-                return (key, datetime(year=key.year+1, month=1, day=1))
-            return (key, datetime(year=key.year, month=key.month+1, day=1))
+                return (key, datetime(year=key.year+1, month=1, day=1, tzinfo=key.tzinfo))
+            return (key, datetime(year=key.year, month=key.month+1, day=1, tzinfo=key.tzinfo))
         elif self.period is TimePeriod.WEEK:
             return (key, key + timedelta(days=7))
         elif self.period is TimePeriod.DAY:
@@ -321,116 +864,571 @@ class TimeDivider:
     def createtrcount(self, key):
         return TimeRangeCount(self.getrange(key))
 
-def count_message(msg, ctr, p_ctr):
-    if ctr is None:
-        print("no count object")
-        return
+    # the keys of many messages at once, from a numpy array of their timestamps (nan if missing).
+    # the period boundaries they span are worked out once with getrange, then each timestamp
+    # is placed between them with searchsorted. returns the keys, and each message's index into
+    # them (-1 for no timestamp)
+    def bucket_times(self, timestamps_ms):
+        known = ~np.isnan(timestamps_ms)
+        if self.period == TimePeriod.ALL or not known.any():
+            return [], np.full(len(timestamps_ms), -1)
+        keys = [self.getkey(self.todatetime(timestamps_ms[known].min()))]
+        bounds = [keys[0].timestamp() * 1000]
+        last = timestamps_ms[known].max()
+        while True:
+            end = self.getrange(keys[-1])[1]
+            if end.timestamp() * 1000 > last:
+                break
+            keys.append(end)
+            bounds.append(end.timestamp() * 1000)
+        ids = np.searchsorted(np.array(bounds), timestamps_ms, side="right") - 1
+        ids[~known] = -1
+        return keys, ids
+
+    # add all counts from another TimeDivider with the same period into this one
+    def merge(self, other):
+        if other.period != self.period:
+            raise ValueError("can't merge {} counts into {} counts".format(other.period.describe(), self.period.describe()))
+        if other.tz != self.tz:
+            raise ValueError("can't merge counts in timezone {} into counts in timezone {}".format(other.tz, self.tz))
+        if None not in (self.settings, other.settings) and other.settings != self.settings:
+            raise ValueError("can't merge counts made with {} into counts made with {}".format(
+                describe_settings(other.settings), describe_settings(self.settings)))
+        for key, trc in other.trcounts.items():
+            if key not in self.trcounts:
+                self.trcounts[key] = self.createtrcount(key)
+            self.trcounts[key].merge(trc)
+        self.latest_ms = later(self.latest_ms, other.latest_ms)
+        self.index = None
+        self.top = None
+        return self
+
+    def prefix_index(self):
+        if self.index is None:
+            self.index = PrefixIndex.build(self)
+        return self.index
+
+    # the TOP_COUNT most used items of each of TOP_KEYS in every bucket, most used first,
+    # so charts of what was used most in each period never have to sort whole counters
+    def rank_top(self):
+        if self.stored_top() is None:
+            self.top = {usekey: {key: trc.allcount[usekey].most_common(TOP_COUNT) for key, trc in self.trcounts.items()}
+                for usekey in TOP_KEYS}
+        return self.top
+
+    def stored_top(self):
+        return self.top
+
+    # a bucket's most used items of usekey from rank_top, or None if they weren't ranked
+    def ranked(self, usekey, key):
+        top = self.stored_top()
+        if top is None or usekey not in top:
+            return None
+        return top[usekey].get(key)
 
-    sender = ""
-    if "sender_name" in msg:
-        sender = msg["sender_name"]
-    if sender not in p_ctr:
-        p_ctr[sender] = create_count()
+    # top with bucket keys as they're saved
+    def top_serializable(self):
+        top = self.stored_top()
+        if top is None:
+            return None
+        return {usekey: {(key.timestamp() if isinstance(key, datetime) else key): ranked for key, ranked in buckets.items()}
+            for usekey, buckets in top.items()}
 
-    ctr["msg"] += 1
-    p_ctr[sender]["msg"] += 1
+    def decode_top(self, dct):
+        if dct is None:
+            return None
+        return {usekey: {(key if key == TimeDivider.ALL_KEY else self.todatetime(float(key) * 1000)): [tuple(pair) for pair in ranked]
+            for key, ranked in buckets.items()} for usekey, buckets in dct.items()}
+
+    # counts for any window of time, [start, end) (either can be None for no limit), from prefix_index.
+    # windows are counted in whole time periods: every period starting inside the window is included
+    def query(self, start=None, end=None):
+        if self.period == TimePeriod.ALL:
+            raise ValueError("all-time counts can't be split into windows, count a time period")
+        # times without a timezone are in the analysis' timezone
+        if start is not None and start.tzinfo is None and self.zone is not None:
+            start = start.replace(tzinfo=self.zone)
+        if end is not None and end.tzinfo is None and self.zone is not None:
+            end = end.replace(tzinfo=self.zone)
+        return self.prefix_index().query(start, end, self.zone)
+
+    # a new TimeDivider with a coarser period, built by merging this one's buckets
+    # instead of counting all the messages again
+    def rollup(self, period):
+        if not self.period.nests_in(period):
+            raise ValueError("{} counts can't be rolled up into {} counts".format(self.period.describe(), period.describe()))
+        td = TimeDivider(period, self.tz)
+        td.settings = self.settings
+        td.alltime().merge(self.alltime())
+        td.latest_ms = self.latest_ms
+        if period == TimePeriod.ALL:
+            return td
+        for key in self.getallkeys():
+            timekey = td.getkey(key)
+            if timekey not in td.trcounts:
+                td.trcounts[timekey] = td.createtrcount(timekey)
+            td.trcounts[timekey].merge(self.trcounts[key])
+        return td
+
+# several TimeDividers with different periods, counted in a single pass.
+# only periods that can't be rolled up from a finer one are counted message by message,
+# the rest are built from those in finish().
+class MultiDivider:
+    def __init__(self, periods, tz=None):
+        self.dividers = {}
+        self.counted = []
+        periods = sorted(set(periods), key=lambda p: p.value, reverse=True) # finest first
+        for period in periods:
+            if not any(td.period.nests_in(period) for td in self.counted):
+                self.counted.append(TimeDivider(period, tz))
+        for td in self.counted:
+            self.dividers[td.period] = td
+        self.periods = periods
+
+    @staticmethod
+    def decode(dct):
+        md = MultiDivider([])
+        for td in dct["dividers"].values():
+            md.dividers[td.period] = td
+            md.periods.append(td.period)
+        md.counted = list(md.dividers.values())
+        return md
+
+    def serializable(self):
+        s = {}
+        s[SPECIAL_MULTIDIVIDER] = True
+        s["dividers"] = {}
+        for period, td in self.dividers.items():
+            s["dividers"][period.value] = td.serializable()
+        return s
+
+    @property
+    def tz(self):
+        return self.counted[0].tz
+
+    @property
+    def settings(self):
+        return self.counted[0].settings
+
+    @property
+    def latest_ms(self):
+        return max((td.latest_ms for td in self.counted if td.latest_ms is not None), default=None)
+
+    def alltime(self):
+        return self.counted[0].alltime()
+
+    # the shortest period, which windows are queried from
+    def finest(self):
+        return max(self.dividers.values(), key=lambda td: td.period.value)
+
+    def prefix_index(self):
+        return self.finest().prefix_index()
+
+    def rank_top(self):
+        for td in self.dividers.values():
+            td.rank_top()
+
+    def query(self, start=None, end=None):
+        return self.finest().query(start, end)
+
+    def get(self, period):
+        if period not in self.dividers:
+            raise ValueError("no {} counts in this analysis (have {})".format(period.describe(),
+                ", ".join(p.describe() for p in self.dividers)))
+        return self.dividers[period]
+
+    def message(self, msg):
+        self.count(extract_features(msg))
+
+    def count(self, feats):
+        for td in self.counted:
+            td.count(feats)
+
+    # merge another MultiDivider (made for the same periods, before finish())
+    def merge(self, other):
+        for td in self.counted:
+            td.merge(other.dividers[td.period])
+        return self
+
+    # build the periods that weren't counted directly, each from the finest counted period that fits in it
+    def finish(self):
+        for period in self.periods:
+            if period not in self.dividers:
+                base = next(td for td in self.counted if td.period.nests_in(period))
+                self.dividers[period] = base.rollup(period)
+        return self
+
+# running totals of the counts in INDEX_KEYS (and sentiment_total) for everyone and each participant,
+# one row per time period of a TimeDivider. the counts of any run of periods are then
+# a single subtraction, however many periods it covers
+class PrefixIndex:
+    def __init__(self, starts, end, names, counts, sentiment):
+        self.starts = starts        # start of each time period, as a timestamp
+        self.end = end              # end of the last time period
+        self.names = names          # participants; row 0 of counts / sentiment is everyone, then these
+        self.counts = counts        # int array [everyone + names, periods + 1, INDEX_KEYS], running totals from 0
+        self.sentiment = sentiment  # same for the sentiment_total [polarity, subjectivity] sums
+
+    @staticmethod
+    def build(td):
+        keys = td.getallkeys()
+        names = sorted(td.alltime().percount)
+        rows = {name: i+1 for i, name in enumerate(names)}
+        counts = np.zeros((len(names)+1, len(keys)+1, len(INDEX_KEYS)), dtype=np.int64)
+        sentiment = np.zeros((len(names)+1, len(keys)+1, 2))
+        for j, key in enumerate(keys):
+            trc = td.trcounts[key]
+            for row, ctr in [(0, trc.allcount)] + [(rows[name], pc) for name, pc in trc.percount.items()]:
+                counts[row, j+1] = [ctr[k] for k in INDEX_KEYS]
+                sentiment[row, j+1] = ctr["sentiment_total"]
+        starts = np.array([key.timestamp() for key in keys])
+        end = td.getrange(keys[-1])[1].timestamp() if keys else None
+        return PrefixIndex(starts, end, names, np.cumsum(counts, axis=1), np.cumsum(sentiment, axis=1))
+
+    # as binary analyses used to save it, as json lists
+    @staticmethod
+    def decode(dct):
+        return PrefixIndex(np.array(dct["starts"], dtype=float), dct["end"], dct["names"],
+            np.array(dct["counts"], dtype=np.int64).reshape(len(dct["names"])+1, len(dct["starts"])+1, len(dct["keys"])),
+            np.array(dct["sentiment"], dtype=float).reshape(len(dct["names"])+1, len(dct["starts"])+1, 2))
+
+    # a TimeRangeCount with only INDEX_KEYS and sentiment_total, for the periods starting in [start, end)
+    def query(self, start=None, end=None, zone=None):
+        first = 0 if start is None else int(np.searchsorted(self.starts, start.timestamp(), side="left"))
+        last = len(self.starts) if end is None else int(np.searchsorted(self.starts, end.timestamp(), side="left"))
+        last = max(first, last)
+        counts = self.counts[:, last] - self.counts[:, first]
+        sentiment = self.sentiment[:, last] - self.sentiment[:, first]
+
+        def ctr(row):
+            c = dict(zip(INDEX_KEYS, counts[row].tolist()))
+            c["sentiment_total"] = sentiment[row].tolist()
+            return c
+
+        trc = TimeRangeCount()
+        if first < last:
+            enddt = self.end if last == len(self.starts) else self.starts[last]
+            trc.timerange = (datetime.fromtimestamp(self.starts[first], zone), datetime.fromtimestamp(enddt, zone))
+        trc.allcount = ctr(0)
+        trc.percount = {name: ctr(i+1) for i, name in enumerate(self.names) if counts[i+1].any()}
+        return trc
+
+def later(a_ms, b_ms):
+    if a_ms is None:
+        return b_ms
+    if b_ms is None:
+        return a_ms
+    return max(a_ms, b_ms)
+
+def create_divider(period, tz=TIMEZONE):
+    if isinstance(period, (list, tuple)):
+        return MultiDivider(period, tz)
+    return TimeDivider(period=period, tz=tz)
+
+# everything counted about one message, extracted once so that it can be applied
+# to any number of counters (all-time, time period, ...) without redoing the work
+class MessageFeatures:
+    __slots__ = ("sender", "timestamp_ms", "timekey", "kinds", "stickers", "photos", "shares",
+                 "content", "emoji", "words", "sentiment", "reactions")
+
+    def __init__(self):
+        self.sender = ""
+        self.timestamp_ms = None
+        self.timekey = None     # filled in by a TimeDivider
+        self.kinds = []         # which of "sticker", "photos", "share" the message is
+        self.stickers = []
+        self.photos = []
+        self.shares = []
+        self.content = False
+        self.emoji = []
+        self.words = []
+        self.sentiment = None
+        self.reactions = []     # (reaction, actor) pairs
+
+# msg as iter_messages or loadjson(repair=True) give it, with its text fixed already
+def extract_features(msg):
+    feats = MessageFeatures()
+
+    if "sender_name" in msg:
+        feats.sender = msg["sender_name"]
+    if "timestamp_ms" in msg:
+        feats.timestamp_ms = msg["timestamp_ms"]
 
     # what kind of message is it?
-    for key in ("sticker", "photos", "share"):
-        if key in msg:
-            ctr[key] += 1
-            p_ctr[sender][key] += 1
+    feats.kinds = [key for key in ("sticker", "photos", "share") if key in msg]
 
-    # track sticker usage
+    # sticker usage
     if "sticker" in msg:
         sticker = "unknown"
         if "uri" in msg["sticker"]:
             sticker = msg["sticker"]["uri"]
-        ctr["sticker_use"][sticker] += 1
-        p_ctr[sender]["sticker_use"][sticker] += 1
+        feats.stickers.append(sticker)
 
-    # track repeated image use
+    # repeated image use
     if "photos" in msg:
         for phobj in msg["photos"]:
             photo = "unknown"
             if "uri" in phobj:
                 photo = phobj["uri"]
-            ctr["photo_use"][photo] += 1
-            p_ctr[sender]["photo_use"][photo] += 1
+            feats.photos.append(photo)
 
-    # track shared link domains
+    # shared link domains
     if "share" in msg:
         if "link" in msg["share"]:
-            domain = urllib.parse.urlparse(msg["share"]["link"]).netloc
-            ctr["share_use"][domain] += 1
-            p_ctr[sender]["share_use"][domain] += 1
+            feats.shares.append(urllib.parse.urlparse(msg["share"]["link"]).netloc)
         #if "share_text" in msg["share"]:
         #if len(msg["share"].keys()) != 1 or "link" not in msg["share"]:
             #print(msg)
 
     if "content" in msg:
-        ctr["content"] += 1
-        p_ctr[sender]["content"] += 1
-
-        # --------
-        # track emoji use
-        i = 0
-        while i < len(msg["content"]):
-            ch = msg["content"][i]
-            chsize = 1
-            if ch == '\u00f0': # emoticon or symbol
-                if i+7 < len(msg["content"]) and msg["content"][i+2] is '\u0087': # country code, 8 bytes
-                    chsize = 8
-                else: # 4 "bytes"
-                    chsize = 4
-            elif ch == '\u00e2' or ch == '\u00e3': # dingbat or other 3 "bytes"
-                chsize = 3
-            elif ch == '\u00c2': # copyright or registered sign
-                chsize = 2
-
-            if chsize != 1:
-                if i + chsize <= len(msg["content"]):
-                    #print("trying to understand ({}) {}".format(chsize, bytes(msg["content"][i:i+chsize], encoding="raw_unicode_escape")))
-                    emoji = weirdbytes_to_utf(msg["content"][i:i+chsize])
-                    ctr["emoji"] += 1
-                    ctr["emoji_use"][emoji] += 1
-
-                    p_ctr[sender]["emoji"] += 1
-                    p_ctr[sender]["emoji_use"][emoji] += 1
-                else:    # message ended before emoji detected?
-                    print("tried to find emoji past end of message")
-
-            i += chsize
-
-        # ----------
-        # track word use
-        for word in msg["content"].split(" "):
-            ctr["words"] += 1
-            ctr["words_use"][word] += 1
-            p_ctr[sender]["words"] += 1
-            p_ctr[sender]["words_use"][word] += 1
-
-        # ---------
         # text processing, sentiment analysis
-        track_sentiment(msg, ctr, p_ctr) 
+        content_features(feats, msg["content"], message_sentiment(msg["content"]))
+
+    if "reactions" in msg:
+        feats.reactions = [(react["reaction"], react["actor"]) for react in msg["reactions"]]
+
+    return feats
+
+def content_features(feats, content, sentiment):
+    feats.content = True
+    feats.emoji = find_emoji(content)
+    feats.words = TOKENIZER(content)
+    feats.sentiment = sentiment
+    return feats
+
+# splits message content into its words, normalized by any of WORD_NORMALIZATIONS:
+# removing links, case folding, stripping punctuation from the ends of words, dropping common words.
+# with no normalization words are split on single spaces, as they always were; with any, on all
+# whitespace, and words left empty aren't counted
+class Tokenizer:
+    def __init__(self, normalize=()):
+        unknown = set(normalize) - set(WORD_NORMALIZATIONS)
+        if unknown:
+            raise ValueError("unknown word normalization {}".format(", ".join(sorted(unknown))))
+        self.normalize = tuple(n for n in WORD_NORMALIZATIONS if n in normalize)
+        self.urls = "urls" in self.normalize
+        self.casefold = "casefold" in self.normalize
+        self.punctuation = "punctuation" in self.normalize
+        self.stopwords = "stopwords" in self.normalize
+
+    @staticmethod
+    def parse(s):
+        return Tokenizer([n for n in s.split(",") if n])
+
+    def __call__(self, content):
+        if not self.normalize:
+            return content.split(" ")
+        if self.urls:
+            content = RE_URL.sub(" ", content)
+        if self.casefold:
+            content = content.casefold()
+        words = content.split()
+        if self.punctuation:
+            words = [w.strip(PUNCTUATION) for w in words]
+        if self.stopwords:
+            if self.casefold:
+                return [w for w in words if w and w not in STOPWORDS]
+            return [w for w in words if w and w.lower() not in STOPWORDS]
+        return [w for w in words if w]
+
+TOKENIZER = Tokenizer()
+
+# full emoji (grapheme clusters: skin tones, ZWJ sequences like families, flags, keycaps, ...) in content
+def find_emoji(content):
+    if content.isascii():
+        return []
+    return RE_EMOJI.findall(content)
+
+# Messenger exports write each utf-8 byte of text as its own character ("ð\x9f\x98\x80" for 😀).
+# histories are read with this fixed already (see fix_escapes); this fixes one string that wasn't.
+# text that isn't like that (already fixed, or made some other way) is returned as it is
+def fix_encoding(text):
+    try:
+        return text.encode("latin-1").decode("utf-8")
+    except UnicodeError:
+        return text
+
+def message_sentiment(content):
+    if content in PRESCORED:
+        return PRESCORED[content]
+
+    if SENTIMENT_CACHE is not None:
+        sentiment = SENTIMENT_CACHE.get(content)
+        if sentiment is not None:
+            return sentiment
+
+    if SENTIMENT_BACKEND == "batch":
+        polarity, subjectivity = batchsentiment.score_batch([content])
+        sentiment = Sentiment(float(polarity[0]), float(subjectivity[0]))
+    else:
+        sentiment = TextBlob(content).sentiment
+        sentiment = Sentiment(sentiment.polarity, sentiment.subjectivity)
+
+    if SENTIMENT_CACHE is not None:
+        SENTIMENT_CACHE.put(content, sentiment)
+    return sentiment
+
+# sentiment of the contents in the shard being counted, scored together by the batch backend
+PRESCORED = {}
+
+def prescore(shard):
+    global PRESCORED
+    PRESCORED = {}
+    pending = {}
+    for msg in shard:
+        if "content" not in msg:
+            continue
+        content = msg["content"]
+        if content in PRESCORED or content in pending:
+            continue
+        cached = None if SENTIMENT_CACHE is None else SENTIMENT_CACHE.get(content)
+        if cached is not None:
+            PRESCORED[content] = cached
+        else:
+            pending[content] = True
+
+    pending = list(pending)
+    polarity, subjectivity = batchsentiment.score_batch(pending)
+    for i in range(len(pending)):
+        sentiment = Sentiment(float(polarity[i]), float(subjectivity[i]))
+        PRESCORED[pending[i]] = sentiment
+        if SENTIMENT_CACHE is not None:
+            SENTIMENT_CACHE.put(pending[i], sentiment)
+    return
+
+# sentiment of recently seen message contents, least recently used dropped first.
+# chats repeat the same short messages ("lol", "ok", ...) a lot, and scoring is slow.
+class SentimentCache:
+    def __init__(self, maxsize=SENTIMENT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.fresh = {}     # scored since the last report()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, content):
+        if content in self.entries:
+            self.entries.move_to_end(content)
+            self.hits += 1
+            return self.entries[content]
+        self.misses += 1
+        return None
+
+    def put(self, content, sentiment):
+        self.entries[content] = sentiment
+        self.entries.move_to_end(content)
+        self.fresh[content] = sentiment
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    # (hits, misses, newly scored contents) since the last report.
+    # lets a pool worker hand its work back to the main process.
+    def report(self):
+        rep = (self.hits, self.misses, self.fresh)
+        self.hits = 0
+        self.misses = 0
+        self.fresh = {}
+        return rep
+
+    # take in another cache's report
+    def absorb(self, fresh):
+        for content, sentiment in fresh.items():
+            self.entries[content] = Sentiment(*sentiment)
+            self.entries.move_to_end(content)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return
+
+    # entries saved as [content, polarity, subjectivity] from least to most recently used.
+    # scores from a different sentiment backend are not loaded
+    def load(self, filename):
+        with open(filename, 'r') as file:
+            saved = json.load(file)
+        if saved["backend"] != SENTIMENT_BACKEND:
+            print("! {} has {} sentiments, not {}; not using them".format(filename, saved["backend"], SENTIMENT_BACKEND))
+            return self
+        for content, polarity, subjectivity in saved["entries"][-self.maxsize:]:
+            self.entries[content] = Sentiment(polarity, subjectivity)
+        return self
+
+    def save(self, filename):
+        with open(filename, 'w') as file:
+            json.dump({
+                "backend" : SENTIMENT_BACKEND,
+                "entries" : [[c, s.polarity, s.subjectivity] for c, s in self.entries.items()],
+            }, file)
+        return
+
+SENTIMENT_CACHE = SentimentCache()
+
+def count_message(msg, ctr, p_ctr):
+    count_features(extract_features(msg), ctr, p_ctr)
+
+def count_features(feats, ctr, p_ctr):
+    if ctr is None:
+        print("no count object")
+        return
+
+    sender = feats.sender
+    if sender not in p_ctr:
+        p_ctr[sender] = create_count()
+    pc = p_ctr[sender]
+
+    ctr["msg"] += 1
+    pc["msg"] += 1
+
+    for key in feats.kinds:
+        ctr[key] += 1
+        pc[key] += 1
+
+    for sticker in feats.stickers:
+        ctr["sticker_use"][sticker] += 1
+        pc["sticker_use"][sticker] += 1
+
+    for photo in feats.photos:
+        ctr["photo_use"][photo] += 1
+        pc["photo_use"][photo] += 1
+
+    for domain in feats.shares:
+        ctr["share_use"][domain] += 1
+        pc["share_use"][domain] += 1
+
+    if feats.content:
+        ctr["content"] += 1
+        pc["content"] += 1
+
+        for emoji in feats.emoji:
+            ctr["emoji"] += 1
+            ctr["emoji_use"][emoji] += 1
+            pc["emoji"] += 1
+            pc["emoji_use"][emoji] += 1
+
+        # counted all at once (Counter.update counts a list in C)
+        words = feats.words
+        ctr["words"] += len(words)
+        ctr["words_use"].update(words)
+        pc["words"] += len(words)
+        pc["words_use"].update(words)
+
+        count_sentiment(feats.sentiment, ctr, pc)
 
     return
 
 def count_reacts(msg, all_ctr, p_ctr):
+    count_feature_reacts(extract_features(msg), all_ctr, p_ctr)
+
+def count_feature_reacts(feats, all_ctr, p_ctr):
     if all_ctr is None or p_ctr is None:
         print("missing count object")
         return
 
-    if "reactions" in msg:
-        name = msg["sender_name"]
+    if feats.reactions:
+        name = feats.sender
         
         all_ctr["reacts_received_messages"] += 1
         p_ctr[name]["reacts_received_messages"] += 1
 
-        for react in msg["reactions"]:
-            content = react["reaction"]
-            actor = react["actor"]
-
+        for content, actor in feats.reactions:
             if actor not in p_ctr:
                 p_ctr[actor] = create_count()
             
@@ -452,18 +1450,72 @@ def count_reacts(msg, all_ctr, p_ctr):
 def track_sentiment(msg, all_ctr, p_ctr):
     if "content" not in msg:
         return
+    count_sentiment(message_sentiment(msg["content"]), all_ctr, p_ctr[msg["sender_name"]])
+    return
 
-    blob = TextBlob(msg["content"])
-    sentiment = blob.sentiment #(blob.sentiment.polarity, blob.sentiment.subjectivity)
-    all_ctr["sentiments"].append(sentiment)
-    all_ctr["sentiment_total"][0] += sentiment.polarity
-    all_ctr["sentiment_total"][1] += sentiment.subjectivity
-    p_ctr[msg["sender_name"]]["sentiments"].append(sentiment)
-    p_ctr[msg["sender_name"]]["sentiment_total"][0] += sentiment.polarity
-    p_ctr[msg["sender_name"]]["sentiment_total"][1] += sentiment.subjectivity
+# add one message's sentiment to the overall and personal counts
+def count_sentiment(sentiment, all_ctr, sender_ctr):
+    for ctr in (all_ctr, sender_ctr):
+        ctr["sentiment_total"][0] += sentiment.polarity
+        ctr["sentiment_total"][1] += sentiment.subjectivity
+        add_sentiment(ctr["sentiment_summary"], sentiment)
+        if "sentiments" in ctr:
+            ctr["sentiments"].append(sentiment)
+    return
 
+# fixed-size description of many messages' sentiment: [polarity, subjectivity] for each of
+# sum, sum of squares, min and max, plus a histogram of each over SENTIMENT_BINS bins
+# (kept as {bin index: count} with only the bins in use, since most counts are small)
+def create_sentiment_summary():
+    return {
+        "n" : 0,
+        "sum" : [0, 0],
+        "sumsq" : [0, 0],
+        "min" : [None, None],
+        "max" : [None, None],
+        "hist" : [{}, {}],
+    }
+
+SENTIMENT_RANGES = ((-1.0, 1.0), (0.0, 1.0))
+
+def add_sentiment(summary, sentiment):
+    summary["n"] += 1
+    for i, value in enumerate(sentiment):
+        summary["sum"][i] += value
+        summary["sumsq"][i] += value * value
+        if summary["min"][i] is None or value < summary["min"][i]:
+            summary["min"][i] = value
+        if summary["max"][i] is None or value > summary["max"][i]:
+            summary["max"][i] = value
+        low, high = SENTIMENT_RANGES[i]
+        b = str(max(0, min(int((value - low) / (high - low) * SENTIMENT_BINS), SENTIMENT_BINS - 1)))
+        summary["hist"][i][b] = summary["hist"][i].get(b, 0) + 1
     return
 
+def merge_sentiment_summary(summary, other):
+    summary["n"] += other["n"]
+    for i in range(2):
+        summary["sum"][i] += other["sum"][i]
+        summary["sumsq"][i] += other["sumsq"][i]
+        if other["min"][i] is not None and (summary["min"][i] is None or other["min"][i] < summary["min"][i]):
+            summary["min"][i] = other["min"][i]
+        if other["max"][i] is not None and (summary["max"][i] is None or other["max"][i] > summary["max"][i]):
+            summary["max"][i] = other["max"][i]
+        for b, count in other["hist"][i].items():
+            summary["hist"][i][b] = summary["hist"][i].get(b, 0) + count
+    return summary
+
+# ((polarity mean, standard deviation), (subjectivity mean, standard deviation))
+def sentiment_spread(summary):
+    if summary["n"] == 0:
+        return ((0, 0), (0.5, 0))
+    spread = []
+    for i in range(2):
+        mean = summary["sum"][i] / summary["n"]
+        variance = max(0, summary["sumsq"][i] / summary["n"] - mean * mean)
+        spread.append((mean, variance ** 0.5))
+    return tuple(spread)
+
 def ratiostr(a, b):
     return str(a) + " / " + str(b) + " (" + str(round(a/b * 100, 3)) + " %)"
 
@@ -500,8 +1552,9 @@ def print_reacts(ctr, total_msgs=None, most_common=2):
 def weirdbytes_to_utf(ch):
     return bytes(ch, encoding='raw_unicode_escape').decode("utf-8")
 
+# works on emoji from before histories were read with their encoding fixed, too
 def get_emoji_name(emojistr):
-    return unicodedata.name(weirdbytes_to_utf(emojistr)[0])
+    return unicodedata.name(fix_encoding(emojistr)[0])
 
 def print_stickers(ctr, most_common=3):
     common_stickers = ctr["sticker_use"].most_common()[:most_common]
@@ -510,27 +1563,202 @@ def print_stickers(ctr, most_common=3):
         print("\t\t{}: {}".format(sticker[1], sticker[0]))
     return
 
-def analyze(chat, period=TimePeriod.ALL, restrict_range=None):
+# chat is a history as loadjson(filename, repair=True) gives it.
+# restrict_range is an optional (start, end) datetime tuple: only messages sent in [start, end) are counted.
+# tz is the timezone name to divide periods in (None for local time)
+def analyze(chat, period=TimePeriod.ALL, restrict_range=None, workers=1, tz=TIMEZONE):
     if "messages" not in chat:
         print("no messages")
         return
  
     messages = chat["messages"]
-
-    total = len(messages)
+    if restrict_range is not None:
+        start_ms = restrict_range[0].timestamp() * 1000
+        end_ms = restrict_range[1].timestamp() * 1000
+        messages = [msg for msg in messages if "timestamp_ms" in msg and start_ms <= msg["timestamp_ms"] < end_ms]
+    return analyze_messages(messages, period, total=len(messages), workers=workers, tz=tz)
+
+# analyze a chat history file, streaming its messages instead of loading it whole
+# filename can also be a thread directory with several message_N.json parts, an export zip,
+# or a columnar store made by columnar.py.
+# through, if given, is a function the stream of messages is passed through on the way (e.g. sqlitestore.MessageWriter.tee)
+def analyze_file(filename, period=TimePeriod.ALL, workers=1, thread=None, through=None, tz=TIMEZONE):
+    import columnar
+    if columnar.isstore(filename):
+        return columnar.analyze_store(filename, period, workers=workers, tz=tz)
+    return analyze_messages(read_through(iter_thread(filename, thread=thread), through), period, workers=workers, tz=tz)
+
+def read_through(messages, through=None):
+    return messages if through is None else through(messages)
+
+# messages can be any iterable; total (if known) is only used for progress output.
+# period can also be a list of periods, which gives a MultiDivider.
+# messages are counted in shards of SHARD_SIZE, each into its own partial result which
+# is then merged into the total. with workers > 1 the shards are counted in a process pool;
+# since shards are always the same and merged in order, the result doesn't depend on workers.
+def analyze_messages(messages, period=TimePeriod.ALL, total=None, workers=1, tz=TIMEZONE):
+    return analyze_shards(count_shard, shards(messages), period, total=total, workers=workers, tz=tz)
+
+# count every shard with func(shard, period, tz), which returns (divider, messages counted, sentiment cache report or None),
+# and merge them all
+def analyze_shards(func, shardlist, period=TimePeriod.ALL, total=None, workers=1, tz=TIMEZONE):
     progress = 0
-    checkpoints = [i * (total // 10) for i in range(1,10)]
+    if total is not None:
+        checkpoints = set(i * (total // 10) for i in range(1,10))
+
+    cachestats = [0, 0]
+
+    td = create_divider(period, tz)
+    for part, size, cachereport in map_shards(func, shardlist, period, tz, workers=workers):
+        for i in range(progress, progress + size):
+            if total is not None and i in checkpoints:
+                print("\t... {}/{}".format(i+1, total))
+            elif total is None and i % STREAM_PROGRESS_EVERY == 0 and i > 0:
+                print("\t... {}".format(i))
+        td.merge(part)
+        progress += size
+
+        if cachereport is not None:
+            cachestats[0] += cachereport[0]
+            cachestats[1] += cachereport[1]
+            SENTIMENT_CACHE.absorb(cachereport[2])
+
+    if SENTIMENT_CACHE is not None and sum(cachestats) > 0:
+        print("sentiment cache: {} hits, {} misses ({} % hit)".format(cachestats[0], cachestats[1],
+            round(cachestats[0] / sum(cachestats) * 100, 3)))
+
+    if isinstance(td, MultiDivider):
+        td.finish()
+    td.rank_top()
+    print_topk_error(td.alltime().allcount)
+    return td
+
+# how far off approximate counts may be
+def print_topk_error(ctr):
+    for key in TOPK_KEYS:
+        if isinstance(ctr[key], TopCounter):
+            print("{}: {} most used of {} kept, counts over by at most {}".format(key,
+                len(ctr[key]), ctr[key].total, ctr[key].error_bound()))
+    return
 
-    td = TimeDivider(period=period)
+# count messages newer than what an existing analysis has already counted, and merge them into it.
+# the analysis remembers the timestamp of its newest message; only messages strictly after that
+# are counted (messages without a timestamp can't be placed, so they are skipped)
+def update_analysis(td, messages, workers=1):
+    return update_with(td, lambda periods, tz: analyze_messages(newer_than(messages, td.latest_ms), periods, workers=workers, tz=tz))
+
+# update_analysis from a history file, thread directory, export zip or columnar store, as analyze_file reads them
+# (through sees every message of the history, not only the new ones)
+def update_file(td, filename, workers=1, thread=None, through=None):
+    import columnar
+    if columnar.isstore(filename):
+        return columnar.update_store(td, filename, workers=workers)
+    return update_analysis(td, read_through(iter_thread(filename, thread=thread), through), workers=workers)
+
+# merge what count(periods, tz) counts of the messages after td.latest_ms into td.
+# new messages are divided into td's periods in td's timezone, and have to be counted with its settings
+def update_with(td, count):
+    if td.latest_ms is None:
+        raise ValueError("analysis doesn't record its newest message, can't tell what is new (analyze the whole history again)")
+    if td.settings is not None and td.settings != counting_settings():
+        raise ValueError("analysis was counted with {}, not {}".format(describe_settings(td.settings), describe_settings(counting_settings())))
+    periods = td.periods if isinstance(td, MultiDivider) else td.period
+    print("counting messages after {}".format(datetime.fromtimestamp(td.latest_ms/1000.0)))
+    new = count(periods, td.tz)
+    print("{} new messages".format(new.alltime().allcount["msg"]))
+    td.merge(new)
+    td.rank_top()
+    return td
+
+def newer_than(messages, timestamp_ms):
+    for msg in messages:
+        if "timestamp_ms" in msg and msg["timestamp_ms"] > timestamp_ms:
+            yield msg
+
+# the settings that change what's counted, saved with every TimeDivider
+def counting_settings():
+    return {"words": list(TOKENIZER.normalize), "topk": TOPK_CAPACITY, "sentiment": SENTIMENT_BACKEND}
+
+def use_counting_settings(settings):
+    global TOKENIZER, TOPK_CAPACITY, SENTIMENT_BACKEND
+    TOKENIZER = Tokenizer(settings["words"])
+    TOPK_CAPACITY = settings["topk"]
+    SENTIMENT_BACKEND = settings["sentiment"]
+
+def describe_settings(settings):
+    return "--words {} --topk {} --sentiment {}".format(",".join(settings["words"]) or "(none)",
+        settings["topk"] or "(exact)", settings["sentiment"])
+
+# module settings that pool workers need in order to count the same way as this process
+def worker_settings():
+    return {
+        "sentiment_cache": SENTIMENT_CACHE,
+        "sentiment_backend": SENTIMENT_BACKEND,
+        "keep_sentiments": KEEP_SENTIMENTS,
+        "topk_capacity": TOPK_CAPACITY,
+        "tokenizer": TOKENIZER,
+    }
+
+def apply_settings(settings):
+    global SENTIMENT_CACHE, SENTIMENT_BACKEND, KEEP_SENTIMENTS, TOPK_CAPACITY, TOKENIZER
+    SENTIMENT_CACHE = settings["sentiment_cache"]
+    SENTIMENT_BACKEND = settings["sentiment_backend"]
+    KEEP_SENTIMENTS = settings["keep_sentiments"]
+    TOPK_CAPACITY = settings["topk_capacity"]
+    TOKENIZER = settings["tokenizer"]
+
+def shards(messages, size=SHARD_SIZE):
+    shard = []
     for msg in messages:
-        if progress in checkpoints:
-            print("\t... {}/{}".format(progress+1, total))
-        # if restrict_range is None or msg in range:
-        td.message(msg)
-        progress += 1
-   
+        shard.append(msg)
+        if len(shard) == size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+# count one shard of messages into a fresh divider
+def count_shard(shard, period, tz):
+    td = create_divider(period, tz)
+    if SENTIMENT_BACKEND == "batch":
+        prescore(shard)
+    timestamps = np.array([msg.get("timestamp_ms", np.nan) for msg in shard], dtype=float)
+    count_bucketed(td, (extract_features(msg) for msg in shard), timestamps)
+    PRESCORED.clear()
+    cachereport = None if SENTIMENT_CACHE is None else SENTIMENT_CACHE.report()
+    return (td, len(shard), cachereport)
+
+# count extracted messages into td, given all their timestamps up front (nan if missing).
+# each period counted message by message works out every message's key at once
+def count_bucketed(td, features, timestamps):
+    buckets = []
+    for divider in (td.counted if isinstance(td, MultiDivider) else [td]):
+        keys, ids = divider.bucket_times(timestamps)
+        buckets.append((divider, [keys[i] if i >= 0 else None for i in ids.tolist()]))
+
+    for i, feats in enumerate(features):
+        for divider, timekeys in buckets:
+            divider.count(feats, timekeys[i])
     return td
 
+# func(shard, *args) for each shard, results yielded in shard order.
+# with a pool, only a few shards per worker are in flight at once so that
+# a streamed history never has to be read into memory ahead of the counting.
+def map_shards(func, shardlist, *args, workers=1):
+    if workers <= 1:
+        for shard in shardlist:
+            yield func(shard, *args)
+        return
+
+    with multiprocessing.Pool(workers, initializer=apply_settings, initargs=(worker_settings(),)) as pool:
+        pending = []
+        for shard in shardlist:
+            pending.append(pool.apply_async(func, (shard,) + args))
+            if len(pending) >= workers * 2:
+                yield pending.pop(0).get()
+        for result in pending:
+            yield result.get()
+
 def print_analysis(td):
     for timekey, trcount in td.trcounts.items():
         print("\n=========== chat stats for " + trcount.rangestr())
@@ -547,23 +1775,122 @@ def print_analysis(td):
         print("============ end stats for " + trcount.rangestr())
     return
 
+def describe_periods(period):
+    if isinstance(period, (list, tuple)):
+        return ", ".join(p.describe() for p in period)
+    return period.describe()
+
+def timezone_name(s):
+    try:
+        zoneinfo.ZoneInfo(s)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        raise argparse.ArgumentTypeError("unknown timezone {}".format(s))
+    return s
+
+def tokenizer_option(s):
+    try:
+        return Tokenizer.parse(s)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="count messages, words, emoji, stickers, reacts, ... in a chat history")
+    parser.add_argument("history", nargs="?", default=TEST_FILE, help="chat history json, a thread directory of message_N.json parts, or an export zip")
+    parser.add_argument("--thread", metavar="NAME", help="which inbox thread of an export zip to analyze")
+    parser.add_argument("analysis", nargs="?", default=TEST_SAVE, help="where to save the analysis (compact binary if it ends in {}, a SQLite database if {})".format(BINARY_EXTENSION, SQLITE_EXTENSION))
+    parser.add_argument("period", nargs="?", default=TEST_PERIOD.name.lower(),
+        help="(a)ll|(y)ear|(m)onth|(w)eek|(d)ay, or several separated by commas")
+    parser.add_argument("--workers", type=int, default=1, help="processes to count messages with")
+    parser.add_argument("--update", metavar="ANALYSIS",
+        help="existing analysis to add newer messages to (its periods are used)")
+    parser.add_argument("--sentiment", choices=SENTIMENT_BACKENDS, default=SENTIMENT_BACKEND,
+        help="score each message with TextBlob, or many at once with batchsentiment (faster, very close)")
+    parser.add_argument("--tz", type=timezone_name, default=TIMEZONE,
+        help="timezone to divide time periods in, e.g. Europe/London (default: this machine's local time)")
+    parser.add_argument("--topk", type=int, metavar="N",
+        help="only track about the N most used words and emoji in each count (approximate, constant memory)")
+    parser.add_argument("--words", type=tokenizer_option, default=TOKENIZER, metavar="NORMALIZATIONS",
+        help="how to normalize words before counting them, any of {} separated by commas".format(",".join(WORD_NORMALIZATIONS)))
+    parser.add_argument("--index", action="store_true",
+        help="save running totals with a binary analysis, so windows of it can be queried without reading its periods")
+    parser.add_argument("--keep-sentiments", action="store_true",
+        help="save every message's sentiment, not just a summary for each count")
+    parser.add_argument("--sentiment-cache", metavar="FILE",
+        help="file to keep scored message sentiments in between runs")
+    parser.add_argument("--sentiment-cache-size", type=int, default=SENTIMENT_CACHE_SIZE,
+        help="distinct message contents to remember sentiment for (0 to turn off)")
+    args = parser.parse_intermixed_args(argv)
+
+    if args.history == TEST_PLACEHOLDER:
+        args.history = TEST_FILE
+    if args.analysis == TEST_PLACEHOLDER:
+        args.analysis = TEST_SAVE
+    args.period = TimePeriod.parse_list(args.period)
+    if len(args.period) == 1:
+        args.period = args.period[0]
+    return args
+
 def main():
-    loadfile = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] != TEST_PLACEHOLDER else TEST_FILE
-    savefile = sys.argv[2] if len(sys.argv) > 2 and sys.argv[2] != TEST_PLACEHOLDER else TEST_SAVE
-    period = TimePeriod.parse(sys.argv[3]) if len(sys.argv) > 3 else TEST_PERIOD
-
-    print("loading messages from {}".format(loadfile))
-    bjork = loadjson(loadfile)
-    print("... loaded. analyzing. ({} period)".format(period.describe()))
-    td = analyze(bjork, period)
+    global SENTIMENT_CACHE, SENTIMENT_BACKEND, KEEP_SENTIMENTS, TOPK_CAPACITY, TOKENIZER
+    args = parse_args(sys.argv[1:])
+
+    SENTIMENT_BACKEND = args.sentiment
+    KEEP_SENTIMENTS = args.keep_sentiments
+    TOPK_CAPACITY = args.topk
+    TOKENIZER = args.words
+
+    SENTIMENT_CACHE = SentimentCache(args.sentiment_cache_size) if args.sentiment_cache_size > 0 else None
+    if SENTIMENT_CACHE is not None and args.sentiment_cache and os.path.exists(args.sentiment_cache):
+        SENTIMENT_CACHE.load(args.sentiment_cache)
+        print("loaded {} cached sentiments from {}".format(len(SENTIMENT_CACHE.entries), args.sentiment_cache))
+
+    if zipfile.is_zipfile(args.history) and args.thread is None:
+        threads = archive_threads(args.history)
+        if len(threads) != 1:
+            print("! {} has {} threads, pick one with --thread (or use inbox.py for all):".format(args.history, len(threads)))
+            print("\n".join(sorted(threads)))
+            return
+
+    # a database also gets the messages themselves, saved as they're read for counting
+    writer = None
+    if args.analysis.endswith(SQLITE_EXTENSION):
+        import sqlitestore, columnar
+        if columnar.isstore(args.history):
+            print("! messages of a columnar store aren't saved to the database, only its analysis")
+        else:
+            writer = sqlitestore.MessageWriter(args.analysis)
+    through = None if writer is None else writer.tee
+
+    if args.update:
+        print("loading analysis from {}".format(args.update))
+        td = load_analysis(args.update, lazy=False)
+        # new messages are counted the way the analysis was, whatever the options say
+        if td.settings is not None and td.settings != counting_settings():
+            print("counting with the analysis' settings: {}".format(describe_settings(td.settings)))
+            use_counting_settings(td.settings)
+        print("streaming new messages from {}".format(args.history))
+        td = update_file(td, args.history, workers=args.workers, thread=args.thread, through=through)
+    else:
+        print("streaming messages from {} ({} period)".format(args.history, describe_periods(args.period)))
+        td = analyze_file(args.history, args.period, workers=args.workers, thread=args.thread, through=through, tz=args.tz)
     
     #print_analysis(td)
 
-    print("saving to {}".format(savefile))
-    savejson(td.serializable(), savefile)
-    print("saved to {}".format(savefile))
+    print("saving to {}".format(args.analysis))
+    if args.index:
+        td.prefix_index()
+    save_analysis(td, args.analysis)
+    print("saved to {}".format(args.analysis))
+
+    if writer is not None:
+        print("saved {} new messages to {}".format(writer.count, args.analysis))
+
+    if SENTIMENT_CACHE is not None and args.sentiment_cache:
+        SENTIMENT_CACHE.save(args.sentiment_cache)
 
     return
 
 if __name__ == '__main__':
+    # so modules that import messages (binstore) share this module's classes
+    sys.modules["messages"] = sys.modules[__name__]
     main()
@@ -3,12 +3,17 @@
 # graph results of facebook messenger chat history analysis
 
 import messages as msgs
-import sys, unicodedata
+import compact
+import sys, os, json, time, argparse, multiprocessing, unicodedata
+import numpy as np # https://www.numpy.org/
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.font_manager as fm
 from matplotlib.offsetbox import OffsetImage, AnnotationBbox, TextArea
 from matplotlib.patches import Rectangle
+from PIL import Image # (installed with matplotlib)
+from collections import OrderedDict
+from itertools import islice
 from datetime import datetime
 from random import randrange, random
 
@@ -17,6 +22,10 @@ from random import randrange, random
 
 STANDARD_STICKER_SIZE = 230400
 DIAG_LABEL_FONT_SIZE = 4
+IMAGE_CACHE_BYTES = 256 << 20   # decoded sticker / photo images kept in memory
+LABEL_DPI = 256                 # dpi image labels are drawn at (that charts with them are saved at)
+ATLAS_WIDTH = 2048              # pixels across the thumbnail atlas
+ATLAS_DIR = None                # directory to keep a thumbnail atlas of stickers in between runs, if any
 
 COLOR_CHOICES = ["red", "blue", "green", "magenta", "orange", "cyan", "purple"]
 DOMAIN_COLORS = {
@@ -30,6 +39,18 @@ DOMAIN_COLORS = {
     "clips.twitch.tv":"purple",
 }
 
+# granularity each chart is drawn at, when the analysis was made for more than one
+CHART_PERIODS = {
+    "personal_by_time_sentiment": msgs.TimePeriod.MONTH,
+    "personal_reacts_given_density": msgs.TimePeriod.MONTH,
+    "reacts_received_density": msgs.TimePeriod.MONTH,
+    "sticker_use": msgs.TimePeriod.MONTH,
+    "link_use": msgs.TimePeriod.MONTH,
+    "emoji_use": msgs.TimePeriod.MONTH,
+    "words_use": msgs.TimePeriod.YEAR,
+    "activity": msgs.TimePeriod.WEEK,
+}
+
 #print(fm.findSystemFonts(fontpaths=None, fontext='ttf'))
 EMOJI_FONT_FILE = "/mnt/c/Windows/Fonts/seguiemj.ttf"
 emoji_font = fm.FontProperties(fname=EMOJI_FONT_FILE, size=DIAG_LABEL_FONT_SIZE)
@@ -47,6 +68,73 @@ def get_sentiment_avg(ctr):
     subjectivity = ctr["sentiment_total"][1] / ctr["content"]
     return (polarity, subjectivity)
 
+# plain counts (messages.INDEX_KEYS, then the sentiment totals) in a frame
+FRAME_KEYS = msgs.INDEX_KEYS + ["polarity_total", "subjectivity_total"]
+
+# a divider's plain counts as dense participants x time matrices, one per FRAME_KEYS, made in one pass
+# over its buckets. charts slice and sum these instead of looking up every cell in the count dicts
+class SeriesFrame:
+    def __init__(self, td):
+        self.period = td.period
+        self.times = td.getallkeys()
+        self.names = list(td.alltime().percount)
+        self.counts = np.zeros((len(FRAME_KEYS), len(self.names), len(self.times)))
+        self.totals = np.zeros((len(FRAME_KEYS), len(self.times)))
+        if isinstance(td, compact.CompactTimeDivider):
+            self.fill_compact(td)
+            return
+        rows = {name: i for i, name in enumerate(self.names)}
+        for j, dt in enumerate(self.times):
+            trc = td.trcounts[dt]
+            self.totals[:, j] = frame_values(trc.allcount)
+            for name, pcount in trc.percount.items():
+                self.counts[:, rows[name], j] = frame_values(pcount)
+
+    # straight from a compact divider's arrays
+    def fill_compact(self, td):
+        buckets = [td.trcounts[dt] for dt in self.times]
+        rowids = np.concatenate([np.arange(trc.start, trc.end) for trc in buckets] + [np.zeros(0, dtype=int)])
+        bucket = np.repeat(np.arange(len(buckets)), [trc.end - trc.start for trc in buckets])
+        values = np.concatenate([td.scalars[rowids], td.sentiment[rowids, 0]], axis=1).T
+        nameids = td.rows[rowids]
+        frame_row = np.full(len(td.tables.items("names")) + 1, -1)
+        frame_row[[td.tables["names"](name) for name in self.names]] = np.arange(len(self.names))
+        everyone = nameids == -1
+        self.totals[:, bucket[everyone]] = values[:, everyone]
+        self.counts[:, frame_row[nameids[~everyone]], bucket[~everyone]] = values[:, ~everyone]
+        return
+
+    def labels(self, mask=None):
+        times = self.times if mask is None else [dt for dt, keep in zip(self.times, mask) if keep]
+        return [dt.strftime(self.period.formats()) for dt in times]
+
+    # participants x time
+    def series(self, key):
+        return self.counts[FRAME_KEYS.index(key)]
+
+    # everyone's, over time
+    def total(self, key):
+        return self.totals[FRAME_KEYS.index(key)]
+
+    # average (polarity, subjectivity) matrices, (0, 0.5) where nothing was said
+    def sentiment_avg(self):
+        content = self.series("content")
+        said = content > 0
+        polarity = np.divide(self.series("polarity_total"), content, out=np.zeros_like(content), where=said)
+        subjectivity = np.divide(self.series("subjectivity_total"), content, out=np.full_like(content, 0.5), where=said)
+        return polarity, subjectivity
+
+def frame_values(ctr):
+    return [ctr[key] for key in msgs.INDEX_KEYS] + list(ctr["sentiment_total"])
+
+# frames of the dividers charts are drawn from, so charts drawn from the same one share it
+FRAMES = {}
+
+def series_frame(td):
+    if id(td) not in FRAMES:
+        FRAMES[id(td)] = (td, SeriesFrame(td))
+    return FRAMES[id(td)][1]
+
 def personal_by_time_sentiment(td):
     minmessages = 60
     width = 0.15
@@ -55,26 +143,18 @@ def personal_by_time_sentiment(td):
     fgs, axs = plt.subplots(2, figsize=(10, 4))
     plt.tight_layout()
 
-    names = [n for n in td.alltime().percount.keys() if td.alltime().percount[n]["msg"] > minmessages]
+    sf = series_frame(td)
+    people = np.array([td.alltime().percount[n]["msg"] > minmessages for n in sf.names], dtype=bool)
+    names = [n for n, keep in zip(sf.names, people) if keep]
 
     periodstr = td.period.describe()
-    times = [dt for dt in td.getallkeys() if td.trcounts[dt].allcount["msg"] > minmessages]
-    timelabels = [dt.strftime(td.period.formats()) for dt in times]
+    times = sf.total("msg") > minmessages
+    timelabels = sf.labels(times)
     timepos = [i for i in range(len(timelabels))]
 
-    personal_polarity = {}
-    personal_subjectivity = {}
-    for name in names:
-        personal_polarity[name] = []
-        personal_subjectivity[name] = []
-        for dt in times:
-            if name in td.trcounts[dt].percount:
-                avgs = get_sentiment_avg(td.trcounts[dt].percount[name])
-                personal_polarity[name].append(avgs[0])
-                personal_subjectivity[name].append(avgs[1])
-            else:
-                personal_polarity[name].append(0)
-                personal_subjectivity[name].append(0.5)
+    polarity, subjectivity = sf.sentiment_avg()
+    personal_polarity = dict(zip(names, polarity[people][:, times]))
+    personal_subjectivity = dict(zip(names, subjectivity[people][:, times]))
 
     plt.title("{} sentiment".format(periodstr.capitalize()))
 
@@ -105,6 +185,26 @@ def personal_by_time_sentiment(td):
     plt.savefig("{}sentiment.png".format(periodstr), format="png", dpi=256)
     return
 
+# messages, reacts given and reacts received by each participant between two dates,
+# from the analysis' prefix index (no need to count the messages again)
+def window_activity(analysis, start, end):
+    trc = analysis.query(start, end)
+    names = sorted(trc.percount, key=lambda n: trc.percount[n]["msg"], reverse=True)
+    ind = [i for i in range(len(names))]
+    width = 0.25
+
+    plt.figure(figsize=(8, 4))
+    plt.title("Activity {}".format(trc.rangestr()))
+    plt.bar([i - width for i in ind], [trc.percount[n]["msg"] for n in names], width, label="messages")
+    plt.bar(ind, [trc.percount[n]["reacts_given"] for n in names], width, label="reacts given")
+    plt.bar([i + width for i in ind], [trc.percount[n]["reacts_received_total"] for n in names], width, label="reacts received")
+    plt.xticks(ind, names, fontsize=6, rotation=30, ha="right")
+    plt.legend(fontsize="small")
+    plt.tight_layout()
+
+    plt.savefig("windowactivity.png", format="png", dpi=256)
+    return
+
 def personal_all_time_sentiment(td):
     plt.figure(figsize=(6, 4))
     plt.title("Participant All-time Average Sentiment")
@@ -212,6 +312,29 @@ def minlength_filter(minlength):
 # def spelling_filter():
 #     return (lambda x : len(SPELLCHECKER.known([x[0]])) != 1, "misspelled")
 
+# the num most used (item, count)s of counter that pass keep, in the order a full sort would give.
+# usually enough of the few most used pass, so those are picked out with a heap first,
+# and the whole counter is only sorted if they don't
+def top_items(counter, num, keep=None):
+    if keep is None:
+        return counter.most_common(num)
+    want = num * 8
+    if want * 8 < len(counter):
+        items = list(islice(filter(keep, counter.most_common(want)), num))
+        if len(items) == num:
+            return items
+    return list(islice(filter(keep, counter.most_common()), num))
+
+# top_items of a bucket's usekey, from the ranking saved with the analysis when there is one.
+# it only holds msgs.TOP_COUNT items, so the whole counter is still searched if too few of them pass
+def top_used(td, key, usekey, num, keep=None):
+    ranked = td.ranked(usekey, key)
+    if ranked is not None:
+        items = list(islice(ranked if keep is None else filter(keep, ranked), num))
+        if len(items) == num or len(ranked) < msgs.TOP_COUNT:
+            return items
+    return top_items(td.trcounts[key].allcount[usekey], num, keep)
+
 def by_period_use(td, countkey, usekey, usefilter=None, num=5, width=0.37, imglabel=False, size=(9,4), showemoji=False, outliermark=300):
     periodstr = td.period.describe()
 
@@ -225,18 +348,15 @@ def by_period_use(td, countkey, usekey, usefilter=None, num=5, width=0.37, imgla
 
     outliers = []
 
-    for dt in times:
-        items = td.trcounts[dt].allcount[usekey].most_common()
-        if usefilter:
-            items = list(filter(usefilter[0], items))
-        items = items[:num]
+    for ti, dt in enumerate(times):
+        items = top_used(td, dt, usekey, num, usefilter[0] if usefilter else None)
 
         for i in range(num):
             if i < len(items):
                 rankings[i][0].append(items[i][0])
                 rankings[i][1].append(items[i][1])
                 if rankings[i][1][-1] > outliermark:
-                    outliers.append((items[i][0], times.index(dt), items[i][1]))
+                    outliers.append((items[i][0], ti, items[i][1]))
                     rankings[i][1][-1] = outliermark
             else:
                 rankings[i][0].append(None)
@@ -332,33 +452,13 @@ def words_use(td):
     return
 
 def personal_reacts_given_density(td):
+    sf = series_frame(td)
     # exclude periods before reacts existed
-    times = [dt for dt in td.getallkeys() if td.trcounts[dt].allcount["reacts_received_total"] != 0]
-    timelabels = [dt.strftime(td.period.formats()) for dt in times]
-
-    activity = []
-    for dt in times:
-        activity.append(td.trcounts[dt].allcount["msg"])
+    times = sf.total("reacts_received_total") != 0
+    timelabels = sf.labels(times)
+    names = sf.names
 
-    personal_activity = {}
-    personal_reacts = {}
-    names = []
-
-    for name, pcount in td.alltime().percount.items():
-        names.append(name)
-        personal_activity[name] = [0] * len(times)
-        personal_reacts[name] = [0] * len(times)
-    
-    for i in range(len(times)):
-        dt = times[i]
-        for name in names:
-            if name in td.trcounts[dt].percount:
-                personal_activity[name][i] = td.trcounts[dt].percount[name]["msg"]
-                personal_reacts[name][i] = td.trcounts[dt].percount[name]["reacts_given"]
-
-    personal_density = {}
-    for name in personal_reacts:
-        personal_density[name] = [personal_reacts[name][i] / activity[i] for i in range(len(times))]
+    personal_density = sf.series("reacts_given")[:, times] / sf.total("msg")[times]
 
     plt.figure(figsize=(9, 4))
     plt.title("Reacts-given Density")
@@ -372,17 +472,12 @@ def personal_reacts_given_density(td):
     return
 
 def reacts_received_density(td):
+    sf = series_frame(td)
     # exclude periods before reacts existed
-    times = [dt for dt in td.getallkeys() if td.trcounts[dt].allcount["reacts_received_total"] != 0]
-    timelabels = [dt.strftime(td.period.formats()) for dt in times]
-
-    activity = []
-    reacts = []
-    for dt in times:
-        activity.append(td.trcounts[dt].allcount["msg"])
-        reacts.append(td.trcounts[dt].allcount["reacts_received_total"])
+    times = sf.total("reacts_received_total") != 0
+    timelabels = sf.labels(times)
 
-    density = [reacts[i] / activity[i] for i in range(len(activity))]
+    density = sf.total("reacts_received_total")[times] / sf.total("msg")[times]
 
     plt.figure(figsize=(9, 4))
     plt.title("{} react density".format(td.period.describe().capitalize()))
@@ -396,22 +491,10 @@ def reacts_received_density(td):
     return
 
 def activity(td): # by-time-period distribution
-    times = td.getallkeys()
-    timelabels = [dt.strftime(td.period.formats()) for dt in times]
-
-    names = []
-    personal_activity = {}
-    for name, pcount in td.alltime().percount.items():
-        names.append(name)
-        personal_activity[name] = [0] * len(timelabels)
-    
-    for i in range(len(times)):
-        dt = times[i]
-        for name in names:
-            if name in td.trcounts[dt].percount:
-                personal_activity[name][i] = td.trcounts[dt].percount[name]["msg"]
-            else:
-                personal_activity[name][i] = 0
+    sf = series_frame(td)
+    timelabels = sf.labels()
+    names = sf.names
+    personal_activity = sf.series("msg")
 
     plt.figure(figsize=(9, 4))
     plt.title("{} activity".format(td.period.describe().capitalize()))
@@ -430,13 +513,8 @@ def all_time_stickers(td, num=15):
 
     rank = [i+1 for i in range(len(sticks))]
     stickfiles = [s[0] for s in sticks]
-    names = []
-    personal_use = {}
-    for name, pcount in allt.percount.items():
-        names.append(name)
-        personal_use[name] = [0] * len(stickfiles)
-        for i in range(len(stickfiles)):
-            personal_use[name][i] = pcount["sticker_use"][stickfiles[i]]
+    names = list(allt.percount)
+    personal_use = [[allt.percount[name]["sticker_use"][stick] for stick in stickfiles] for name in names]
 
     plt.figure(figsize=(9, 4))
     plt.ylabel("Uses")
@@ -453,13 +531,237 @@ def all_time_stickers(td, num=15):
     plt.savefig("alltimestickers.png", format="png", dpi=256)
     return
 
-def add_png_xlabel(filename, ax, xcoord, scale=0.02, ycoord=0):
-    img = plt.imread(filename, format='png')
-    # scale large stickers to roughly match the standard
+# charts that can be picked on the command line, and the ones drawn if none are
+CHARTS = {chart.__name__: chart for chart in (
+    test_plot,
+    personal_all_time_sentiment,
+    personal_by_time_sentiment,
+    sticker_spam,
+    sticker_similarity,
+    personal_reacts_given_density,
+    reacts_received_density,
+    sticker_use,
+    link_use,
+    emoji_use,
+    words_use,
+    activity,
+    all_time_stickers,
+)}
+# charts drawn from a SeriesFrame
+FRAME_CHARTS = ("personal_by_time_sentiment", "personal_reacts_given_density", "reacts_received_density", "activity")
+DEFAULT_CHARTS = ["test_plot", "personal_all_time_sentiment", "personal_by_time_sentiment"]
+
+# the TimeDivider a chart should be drawn from.
+# period overrides CHART_PERIODS; it only matters for multi-period analyses
+def divider_for(analysis, chart, period=None):
+    if not isinstance(analysis, msgs.MultiDivider):
+        return analysis
+    if period is None:
+        period = CHART_PERIODS.get(chart.__name__, msgs.TimePeriod.MONTH)
+    return analysis.get(period)
+
+def plot(chart, analysis, period=None):
+    chart(divider_for(analysis, chart, period))
+
+# decoded images, least recently used dropped first once they take up more than maxbytes
+class ImageCache:
+    def __init__(self, maxbytes=IMAGE_CACHE_BYTES):
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename):
+        if filename in self.entries:
+            self.entries.move_to_end(filename)
+            self.hits += 1
+            return self.entries[filename]
+        self.misses += 1
+        img = plt.imread(filename, format='png')
+        self.entries[filename] = img
+        self.nbytes += img.nbytes
+        while self.nbytes > self.maxbytes and len(self.entries) > 1:
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= old.nbytes
+        return img
+
+IMAGE_CACHE = ImageCache()
+
+# zoom that draws img at scale, with large stickers scaled to roughly match the standard
+def sticker_zoom(img, scale):
     dim = (img.size + img[0].size) / 2
     if dim > STANDARD_STICKER_SIZE:
         scale = scale * (STANDARD_STICKER_SIZE / dim)
-    imagebox = OffsetImage(img, zoom=scale)
+    return scale
+
+# img as RGBA floats, whatever channels the png had
+def rgba(img):
+    if img.dtype == np.uint8:
+        img = img.astype(np.float32) / 255
+    if img.ndim == 2:
+        img = np.stack([img, img, img], axis=-1)
+    if img.shape[2] == 3:
+        img = np.concatenate([img, np.ones(img.shape[:2] + (1,), dtype=img.dtype)], axis=-1)
+    return img
+
+# img resized to how many pixels it takes up when drawn at scale (at LABEL_DPI)
+def thumbnail(img, scale):
+    zoom = sticker_zoom(img, scale) * LABEL_DPI / 72
+    img = rgba(img)
+    return resized(img, (max(1, round(img.shape[1] * zoom)), max(1, round(img.shape[0] * zoom))))
+
+# an rgba image resized to (width, height)
+def resized(img, size):
+    img = Image.fromarray((img * 255).round().astype(np.uint8), "RGBA").resize(size, Image.LANCZOS)
+    return np.asarray(img, dtype=np.float32) / 255
+
+# sticker thumbnails already scaled to the size they're drawn at, packed in rows (shelves) into one png
+# that's kept between runs: each sticker is only decoded and scaled once for every chart that uses it.
+# atlas.json has each thumbnail's place, under its filename and scale, with the file's modification time.
+# a thumbnail whose file has changed is made again (leaving its old space unused).
+# one wider than the atlas is kept scaled down to fit, with how much to zoom it back up by when it's drawn
+class ThumbnailAtlas:
+    def __init__(self, directory):
+        self.directory = directory
+        self.image = np.zeros((0, ATLAS_WIDTH, 4), dtype=np.float32)
+        self.entries = {}   # key: [mtime, x, y, width, height, zoom] (no zoom in older atlases: 1)
+        self.shelf = [0, 0, 0] # x, y and height of the row being filled
+        self.changed = False
+        self.added = []     # (key, mtime, thumbnail) added since take_added()
+        if os.path.exists(self.indexfile()):
+            with open(self.indexfile(), 'r') as file:
+                saved = json.load(file)
+            self.entries = saved["entries"]
+            self.shelf = saved["shelf"]
+            self.image = rgba(plt.imread(self.imagefile(), format='png'))
+
+    def indexfile(self):
+        return os.path.join(self.directory, "atlas.json")
+
+    def imagefile(self):
+        return os.path.join(self.directory, "atlas.png")
+
+    def get(self, filename, scale):
+        key = "{}@{}".format(filename, scale)
+        mtime = os.path.getmtime(filename)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != mtime:
+            entry = self.add(key, mtime, thumbnail(IMAGE_CACHE.get(filename), scale))
+        _, x, y, w, h = entry[:5]
+        return self.image[y:y+h, x:x+w], (entry[5] if len(entry) > 5 else 1)
+
+    def add(self, key, mtime, thumb):
+        self.added.append((key, mtime, thumb))
+        zoom = 1
+        if thumb.shape[1] > ATLAS_WIDTH:
+            zoom = thumb.shape[1] / ATLAS_WIDTH
+            thumb = resized(thumb, (ATLAS_WIDTH, max(1, round(thumb.shape[0] / zoom))))
+        h, w = thumb.shape[:2]
+        x, y, shelfheight = self.shelf
+        if x + w > ATLAS_WIDTH:
+            x, y, shelfheight = 0, y + shelfheight, 0
+        if y + h > self.image.shape[0]:
+            self.image = np.concatenate([self.image, np.zeros((y + h - self.image.shape[0], ATLAS_WIDTH, 4), dtype=np.float32)])
+        self.image[y:y+h, x:x+w] = thumb
+        self.shelf = [x + w, y, max(shelfheight, h)]
+        self.entries[key] = [mtime, x, y, w, h, zoom]
+        self.changed = True
+        return self.entries[key]
+
+    # thumbnails added since the last call, so a render worker can hand them back to be saved
+    def take_added(self):
+        added = self.added
+        self.added = []
+        return added
+
+    # add thumbnails another process made, unless they're already here
+    def absorb(self, added):
+        for key, mtime, thumb in added:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != mtime:
+                self.add(key, mtime, thumb)
+        self.added = []
+        return
+
+    def save(self):
+        if not self.changed:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        plt.imsave(self.imagefile(), self.image, format='png')
+        with open(self.indexfile(), 'w') as file:
+            json.dump({"entries": self.entries, "shelf": self.shelf}, file)
+        self.changed = False
+        return
+
+# set to a ThumbnailAtlas to draw image labels from it
+ATLAS = None
+
+# image to draw filename with, and the zoom to draw it at
+def label_image(filename, scale):
+    if ATLAS is not None:
+        thumb, zoom = ATLAS.get(filename, scale)
+        return thumb, zoom * 72 / LABEL_DPI
+    img = IMAGE_CACHE.get(filename)
+    return img, sticker_zoom(img, scale)
+
+# what charts are drawn from, set before render workers are forked so they share it
+# (a binary analysis is memory-mapped, so they share its pages too)
+RENDER = {"analysis": None, "period": None, "window": None}
+
+# draw one chart (in a render worker, or this process): (name, seconds taken, atlas thumbnails made)
+# a chart that fails is reported by the process drawing the rest, and the others are still drawn
+def render(name):
+    start = time.perf_counter()
+    error = None
+    try:
+        if name == "window_activity":
+            window_activity(RENDER["analysis"], *RENDER["window"])
+        else:
+            plot(CHARTS[name], RENDER["analysis"], RENDER["period"])
+    except Exception as e:
+        error = "{}: {}".format(type(e).__name__, e)
+    plt.close("all")
+    added = ATLAS.take_added() if ATLAS is not None else []
+    return (name, time.perf_counter() - start, added, error)
+
+# draw charts, each in its own worker process from a pool of workers.
+# returns the names of the ones that couldn't be drawn
+def render_charts(analysis, names, period=None, window=None, workers=1):
+    if not names:
+        print("no charts to draw")
+        return []
+    RENDER["analysis"] = analysis
+    RENDER["period"] = period
+    RENDER["window"] = window
+    # made before forking, so that workers drawing from the same divider share its frame
+    for name in names:
+        if name in FRAME_CHARTS:
+            series_frame(divider_for(analysis, CHARTS[name], period))
+    if workers <= 1:
+        results = map(render, names)
+    else:
+        pool = multiprocessing.get_context("fork").Pool(min(workers, len(names)), maxtasksperchild=1)
+        results = pool.imap_unordered(render, names)
+
+    failed = []
+    for name, seconds, added, error in results:
+        if error is None:
+            print("drew {} ({:.1f} s)".format(name, seconds))
+        else:
+            print("! couldn't draw {}: {}".format(name, error))
+            failed.append(name)
+        if ATLAS is not None:
+            ATLAS.absorb(added)
+
+    if workers > 1:
+        pool.close()
+        pool.join()
+    return failed
+
+def add_png_xlabel(filename, ax, xcoord, scale=0.02, ycoord=0):
+    img, zoom = label_image(filename, scale)
+    imagebox = OffsetImage(img, zoom=zoom)
     imagebox.image.axes = ax
     ab = AnnotationBbox(imagebox, (xcoord, ycoord), xybox=(0, -16),
                     xycoords=("data", "axes fraction"),
@@ -486,38 +788,52 @@ def add_text_xlabel(txt, ax, xcoord, rotate=45, yoffset=-15, fontprops=fm.FontPr
     ax.add_artist(ab)
     return
 
+# personal: a row of values over xitems for each of names, stacked in that order
 def add_bar_stack(xitems, names, personal, width=0.5):
-    bars = []
-    top = [0] * len(xitems)
-    for i in range(len(names)):
-        name = names[i]
-        bars.append(plt.bar(xitems, personal[name], width=width, bottom=top))
-        top = [top[j] + personal[name][j] for j in range(len(xitems))]
+    personal = np.asarray(personal, dtype=float).reshape(len(names), len(xitems))
+    bottoms = np.cumsum(personal, axis=0) - personal
+    bars = [plt.bar(xitems, personal[i], width=width, bottom=bottoms[i]) for i in range(len(names))]
     plt.legend(bars, names, fontsize="small")
 
+def chart_list(s):
+    names = list(CHARTS) if s == "all" else [n for n in s.split(",") if n]
+    unknown = [n for n in names if n not in CHARTS]
+    if unknown:
+        raise argparse.ArgumentTypeError("unknown chart {} (charts: {})".format(", ".join(unknown), ", ".join(CHARTS)))
+    return names
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="draw charts of an analysis made by messages.py")
+    parser.add_argument("analysis", nargs="?", default=msgs.TEST_SAVE, help="analysis file (any format messages.py saves)")
+    parser.add_argument("period", nargs="?", type=msgs.TimePeriod.parse,
+        help="(a)ll|(y)ear|(m)onth|(w)eek|(d)ay to draw a multi-period analysis' charts at (default: CHART_PERIODS)")
+    parser.add_argument("--window", nargs=2, metavar=("START", "END"), type=lambda s: datetime.strptime(s, "%Y-%m-%d"),
+        help="also draw activity between two dates, as YYYY-MM-DD")
+    parser.add_argument("--charts", type=chart_list, default=DEFAULT_CHARTS,
+        help="charts to draw separated by commas, or all: {}".format(", ".join(CHARTS)))
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes to draw charts in, one chart each at a time")
+    parser.add_argument("--atlas", metavar="DIR", default=ATLAS_DIR,
+        help="directory to keep a thumbnail atlas of sticker labels in between runs")
+    return parser.parse_intermixed_args(argv)
+
 def main():
-    analysisfile = sys.argv[1] if len(sys.argv) > 1 else msgs.TEST_SAVE
+    global ATLAS
+    args = parse_args(sys.argv[1:])
+    # charts are only ever saved to files, and workers can't share a gui backend
+    matplotlib.use("Agg")
 
-    print("loading analysis from {}".format(analysisfile))
-    td = msgs.loadjson(analysisfile)
+    print("loading analysis from {}".format(args.analysis))
+    # binary analyses lazily, others as arrays, so the workers share them instead of a dict for every count
+    td = compact.open_analysis(args.analysis)
 
     print("analysis loaded, plotting...")
-
-    test_plot(td)
-    personal_all_time_sentiment(td)
-    personal_by_time_sentiment(td)
-    #sticker_spam(td)
-    #sticker_similarity(td)
-    #personal_reacts_given_density(td)
-    #reacts_received_density(td)
-    #sticker_use(td)
-    #link_use(td)
-    #emoji_use(td)
-    #words_use(td)
-    #activity(td)
-    #all_time_stickers(td)
-
-    print("done plotting.")
+    if args.atlas is not None:
+        ATLAS = ThumbnailAtlas(args.atlas)
+    names = args.charts + (["window_activity"] if args.window else [])
+    failed = render_charts(td, names, args.period, args.window, workers=args.workers)
+    if ATLAS is not None:
+        ATLAS.save()
+    print("done plotting." if not failed else "done plotting, {} of {} charts failed.".format(len(failed), len(names)))
 
     return
 
@@ -0,0 +1,280 @@
+# save an analysis (and optionally the messages themselves) into a SQLite database,
+# for asking questions with plain SQL instead of writing Python against TimeDividers.
+#
+# each TimeDivider is a row of dividers (with its counting settings as json), each of its time periods a row of buckets (all-time has no start).
+# a bucket's counts are stored per participant (participant_id NULL for everyone):
+#   scalars: plain numbers (msg, sticker, words, reacts_given, ...)
+#   items: the COUNTER_KEYS counts, one row per (counter, item)
+#   summaries: everything else (sentiment_total, sentiment_summary, top-k counter sizes) as json
+# messages are normalized into messages, reactions, stickers, photos and shares.
+#
+# e.g. top words by Alice in March 2018:
+#   SELECT item, count FROM items
+#   JOIN buckets ON buckets.id = bucket_id JOIN dividers ON dividers.id = divider_id
+#   JOIN participants ON participants.id = participant_id
+#   WHERE dividers.period = 2 AND buckets.label LIKE '2018-03%' AND counter = 'words_use' AND name = 'Alice'
+#   ORDER BY count DESC LIMIT 10;
+# and react counts by actor:
+#   SELECT name, COUNT(*) FROM reactions JOIN participants ON participants.id = actor_id GROUP BY name;
+import json, sqlite3, urllib.parse
+from collections import Counter
+import messages as msgs
+
+SQLITE_MAGIC = b"SQLite format 3\x00"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS participants (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY, timestamp_ms INTEGER, sender_id INTEGER REFERENCES participants(id),
+    is_sticker INTEGER, is_photos INTEGER, is_share INTEGER, content TEXT);
+CREATE TABLE IF NOT EXISTS reactions (
+    message_id INTEGER REFERENCES messages(id), actor_id INTEGER REFERENCES participants(id), reaction TEXT);
+CREATE TABLE IF NOT EXISTS stickers (message_id INTEGER REFERENCES messages(id), uri TEXT);
+CREATE TABLE IF NOT EXISTS photos (message_id INTEGER REFERENCES messages(id), uri TEXT);
+CREATE TABLE IF NOT EXISTS shares (message_id INTEGER REFERENCES messages(id), link TEXT, domain TEXT);
+
+CREATE TABLE IF NOT EXISTS dividers (id INTEGER PRIMARY KEY, period INTEGER, tz TEXT, latest_ms INTEGER, settings TEXT);
+CREATE TABLE IF NOT EXISTS buckets (
+    id INTEGER PRIMARY KEY, divider_id INTEGER REFERENCES dividers(id), start REAL, end REAL, label TEXT);
+CREATE TABLE IF NOT EXISTS scalars (
+    bucket_id INTEGER REFERENCES buckets(id), participant_id INTEGER REFERENCES participants(id), key TEXT, value);
+CREATE TABLE IF NOT EXISTS items (
+    bucket_id INTEGER REFERENCES buckets(id), participant_id INTEGER REFERENCES participants(id),
+    counter TEXT, item TEXT, count INTEGER, error INTEGER);
+CREATE TABLE IF NOT EXISTS summaries (
+    bucket_id INTEGER REFERENCES buckets(id), participant_id INTEGER REFERENCES participants(id), key TEXT, value TEXT);
+
+CREATE INDEX IF NOT EXISTS messages_time ON messages(timestamp_ms);
+CREATE INDEX IF NOT EXISTS messages_sender ON messages(sender_id, timestamp_ms);
+CREATE INDEX IF NOT EXISTS reactions_message ON reactions(message_id);
+CREATE INDEX IF NOT EXISTS reactions_actor ON reactions(actor_id);
+CREATE INDEX IF NOT EXISTS stickers_message ON stickers(message_id);
+CREATE INDEX IF NOT EXISTS stickers_uri ON stickers(uri);
+CREATE INDEX IF NOT EXISTS photos_message ON photos(message_id);
+CREATE INDEX IF NOT EXISTS shares_message ON shares(message_id);
+CREATE INDEX IF NOT EXISTS shares_domain ON shares(domain);
+CREATE INDEX IF NOT EXISTS buckets_time ON buckets(divider_id, start);
+CREATE INDEX IF NOT EXISTS scalars_bucket ON scalars(bucket_id, participant_id, key);
+CREATE INDEX IF NOT EXISTS items_bucket ON items(bucket_id, counter, participant_id);
+CREATE INDEX IF NOT EXISTS items_item ON items(counter, item);
+CREATE INDEX IF NOT EXISTS summaries_bucket ON summaries(bucket_id, participant_id);
+"""
+
+ANALYSIS_TABLES = ("summaries", "items", "scalars", "buckets", "dividers")
+
+def connect(filename):
+    conn = sqlite3.connect(filename)
+    conn.executescript(SCHEMA)
+    # databases from before dividers had settings
+    if "settings" not in [row[1] for row in conn.execute("PRAGMA table_info(dividers)")]:
+        conn.execute("ALTER TABLE dividers ADD COLUMN settings TEXT")
+    return conn
+
+def isdatabase(filename):
+    with open(filename, 'rb') as file:
+        return file.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+# id of every name, adding the ones not in participants yet
+def participant_ids(conn, names):
+    conn.executemany("INSERT OR IGNORE INTO participants (name) VALUES (?)", ((name,) for name in set(names)))
+    return dict(conn.execute("SELECT name, id FROM participants").fetchall())
+
+# replace the analysis in the database with td
+def save(td, filename):
+    conn = connect(filename)
+    dividers = td.dividers.values() if isinstance(td, msgs.MultiDivider) else [td]
+    with conn:
+        for table in ANALYSIS_TABLES:
+            conn.execute("DELETE FROM {}".format(table))
+        ids = participant_ids(conn, td.alltime().percount.keys())
+        for divider in dividers:
+            cur = conn.execute("INSERT INTO dividers (period, tz, latest_ms, settings) VALUES (?, ?, ?, ?)",
+                (divider.period.value, divider.tz, divider.latest_ms, None if divider.settings is None else json.dumps(divider.settings)))
+            divider_id = cur.lastrowid
+            for key, trc in divider.trcounts.items():
+                if key == msgs.TimeDivider.ALL_KEY:
+                    row = (divider_id, None, None, "all")
+                else:
+                    row = (divider_id, key.timestamp(), trc.timerange[1].timestamp(), key.isoformat())
+                bucket_id = conn.execute("INSERT INTO buckets (divider_id, start, end, label) VALUES (?, ?, ?, ?)", row).lastrowid
+                save_count(conn, bucket_id, None, trc.allcount)
+                for name, pcount in trc.percount.items():
+                    save_count(conn, bucket_id, ids[name], pcount)
+    conn.close()
+    return
+
+def save_count(conn, bucket_id, participant_id, ctr):
+    scalars = []
+    summaries = []
+    for key, value in ctr.items():
+        if key in msgs.COUNTER_KEYS:
+            errors = {}
+            if isinstance(value, msgs.TopCounter):
+                errors = value.errors
+                summaries.append((bucket_id, participant_id, key, json.dumps({"capacity": value.capacity, "total": value.total})))
+            conn.executemany("INSERT INTO items (bucket_id, participant_id, counter, item, count, error) VALUES (?, ?, ?, ?, ?, ?)",
+                ((bucket_id, participant_id, key, item, count, errors.get(item)) for item, count in value.items()))
+        elif isinstance(value, (int, float)):
+            scalars.append((bucket_id, participant_id, key, value))
+        else:
+            summaries.append((bucket_id, participant_id, key, json.dumps(value)))
+    conn.executemany("INSERT INTO scalars (bucket_id, participant_id, key, value) VALUES (?, ?, ?, ?)", scalars)
+    conn.executemany("INSERT INTO summaries (bucket_id, participant_id, key, value) VALUES (?, ?, ?, ?)", summaries)
+    return
+
+# add messages to the database, skipping the ones it already has (see MessageWriter).
+# returns how many were added
+def save_messages(filename, messages):
+    writer = MessageWriter(filename)
+    for _ in writer.tee(messages):
+        pass
+    return writer.count
+
+# saves messages into the database as they stream past on their way to being counted,
+# in one transaction per shard, so the history is only read once.
+# a message is already there if the database had one with the same time, sender, kind and content
+# before this started (as many times as it had it), so a database can be brought up to date from a
+# newer history without losing messages sent in the same millisecond, or ones without a time
+class MessageWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+        self.matched = Counter() # keys of messages found in the database already
+
+    # messages, unchanged, saving them on the way through
+    def tee(self, messages):
+        conn = connect(self.filename)
+        self.before = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+        shard = []
+        for msg in messages:
+            yield msg
+            shard.append(msg)
+            if len(shard) == msgs.SHARD_SIZE:
+                self.save(conn, shard)
+                shard = []
+        if shard:
+            self.save(conn, shard)
+        conn.close()
+
+    def save(self, conn, shard):
+        if self.before > 0:
+            shard = self.new_messages(conn, shard)
+        save_shard(conn, shard)
+        self.count += len(shard)
+        return
+
+    # the messages of shard the database didn't have before
+    def new_messages(self, conn, shard):
+        times = [msg["timestamp_ms"] for msg in shard if msg.get("timestamp_ms") is not None]
+        where = []
+        params = [self.before]
+        if times:
+            where.append("timestamp_ms BETWEEN ? AND ?")
+            params += [min(times), max(times)]
+        if len(times) < len(shard):
+            where.append("timestamp_ms IS NULL")
+        existing = Counter(conn.execute("SELECT timestamp_ms, name, is_sticker, is_photos, is_share, content FROM messages "
+            "JOIN participants ON participants.id = sender_id WHERE messages.id <= ? AND ({})".format(" OR ".join(where)), params))
+        new = []
+        for msg in shard:
+            key = message_key(msg)
+            if existing[key] > self.matched[key]:
+                self.matched[key] += 1
+            else:
+                new.append(msg)
+        return new
+
+# what a message is told apart by, as a row of the messages table (joined with the sender's name)
+def message_key(msg):
+    return (msg.get("timestamp_ms"), msg.get("sender_name", ""), int("sticker" in msg), int("photos" in msg),
+        int("share" in msg), msg.get("content"))
+
+# one shard of messages into the message tables, in one transaction
+def save_shard(conn, shard):
+    with conn:
+        names = [msg.get("sender_name", "") for msg in shard]
+        names += [react["actor"] for msg in shard for react in msg.get("reactions", [])]
+        ids = participant_ids(conn, names)
+        first = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM messages").fetchone()[0]
+        conn.executemany("INSERT INTO messages (id, timestamp_ms, sender_id, is_sticker, is_photos, is_share, content) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((first + i, msg.get("timestamp_ms"), ids[msg.get("sender_name", "")],
+                "sticker" in msg, "photos" in msg, "share" in msg, msg.get("content")) for i, msg in enumerate(shard)))
+        conn.executemany("INSERT INTO reactions (message_id, actor_id, reaction) VALUES (?, ?, ?)",
+            ((first + i, ids[react["actor"]], react["reaction"]) for i, msg in enumerate(shard) for react in msg.get("reactions", [])))
+        conn.executemany("INSERT INTO stickers (message_id, uri) VALUES (?, ?)",
+            ((first + i, msg["sticker"].get("uri", "unknown")) for i, msg in enumerate(shard) if "sticker" in msg))
+        conn.executemany("INSERT INTO photos (message_id, uri) VALUES (?, ?)",
+            ((first + i, phobj.get("uri", "unknown")) for i, msg in enumerate(shard) for phobj in msg.get("photos", [])))
+        conn.executemany("INSERT INTO shares (message_id, link, domain) VALUES (?, ?, ?)",
+            ((first + i, msg["share"]["link"], urllib.parse.urlparse(msg["share"]["link"]).netloc)
+                for i, msg in enumerate(shard) if "share" in msg and "link" in msg["share"]))
+    return
+
+# read the analysis back into TimeDividers (a MultiDivider if there are several)
+def load(filename):
+    conn = connect(filename)
+    names = {pid: name for name, pid in conn.execute("SELECT name, id FROM participants")}
+    dividers = []
+    for divider_id, period, tz, latest_ms, settings in conn.execute("SELECT id, period, tz, latest_ms, settings FROM dividers ORDER BY id").fetchall():
+        td = msgs.TimeDivider(msgs.TimePeriod(period), tz)
+        td.latest_ms = latest_ms
+        td.settings = None if settings is None else json.loads(settings)
+        td.trcounts = {}
+        buckets = {}
+        for bucket_id, start in conn.execute("SELECT id, start FROM buckets WHERE divider_id = ? ORDER BY id", (divider_id,)):
+            if start is None:
+                key = msgs.TimeDivider.ALL_KEY
+                trc = msgs.TimeRangeCount()
+            else:
+                key = td.todatetime(start * 1000)
+                trc = td.createtrcount(key)
+            trc.percount = {}
+            td.trcounts[key] = trc
+            buckets[bucket_id] = trc
+
+        def count(bucket_id, participant_id):
+            trc = buckets[bucket_id]
+            if participant_id is None:
+                return trc.allcount
+            name = names[participant_id]
+            if name not in trc.percount:
+                trc.percount[name] = msgs.create_count()
+            return trc.percount[name]
+
+        bucket_ids = "SELECT id FROM buckets WHERE divider_id = ?"
+        for bucket_id, participant_id, key, value in conn.execute(
+                "SELECT bucket_id, participant_id, key, value FROM scalars WHERE bucket_id IN ({}) ORDER BY rowid".format(bucket_ids), (divider_id,)):
+            count(bucket_id, participant_id)[key] = value
+
+        # top-k counters are filled in as saved (see TopCounter.serializable) and decoded once complete
+        topk = {}
+        for bucket_id, participant_id, key, value in conn.execute(
+                "SELECT bucket_id, participant_id, key, value FROM summaries WHERE bucket_id IN ({}) ORDER BY rowid".format(bucket_ids), (divider_id,)):
+            value = json.loads(value)
+            if key in msgs.COUNTER_KEYS:
+                value = {"capacity": value["capacity"], "total": value["total"], "counts": {}, "errors": {}}
+                topk[(bucket_id, participant_id, key)] = value
+            count(bucket_id, participant_id)[key] = value
+        for bucket_id, participant_id, counter, item, n, error in conn.execute(
+                "SELECT bucket_id, participant_id, counter, item, count, error FROM items WHERE bucket_id IN ({}) ORDER BY rowid".format(bucket_ids), (divider_id,)):
+            ctr = count(bucket_id, participant_id)[counter]
+            if (bucket_id, participant_id, counter) in topk:
+                ctr["counts"][item] = n
+                if error:
+                    ctr["errors"][item] = error
+            else:
+                ctr[item] = n
+        for (bucket_id, participant_id, key), value in topk.items():
+            count(bucket_id, participant_id)[key] = msgs.TopCounter.decode(value)
+        dividers.append(td)
+    conn.close()
+
+    if len(dividers) == 1:
+        return dividers[0]
+    md = msgs.MultiDivider([])
+    for td in dividers:
+        md.dividers[td.period] = td
+        md.periods.append(td.period)
+    md.counted = list(md.dividers.values())
+    return md
@@ -0,0 +1,47 @@
+# batchsentiment.py has to score every message the way TextBlob does, to within BATCH_TOLERANCE.
+# run with: python -m pytest test_batchsentiment.py
+import random
+from textblob import TextBlob # https://textblob.readthedocs.io/
+import batchsentiment
+
+# chains of intensifiers, negations, "!"s and emoticons, which interact in pattern's scoring
+CHAINS = [
+    "good", "not good", "very good", "not very good", "very not good", "really not good", "not really good",
+    "extremely no awful", "no never extremely really awful", "totally no good", "never barely barely terrible ! so",
+    "is totally no terrible not it", "i totally ! no i happy !!", "no ! totally very n't bad", "really !! no !",
+    "! really :( not", "extremely i n't :) great awful great", "barely a a :) i awful is awful", "barely n't no",
+    "not !! i very a :) awful", "so good!!!", "very good!", "very ! good", "NOT bad at all", "I didn't love it :(",
+    "it isn't very nice... but okay", "wow :D amazing", "<3 <3 love", "it was not not bad", "really, really good",
+    "", "!!!", ":)", "lol",
+]
+
+WORDS = ["very", "really", "extremely", "so", "quite", "not", "never", "n't", "no", "good", "bad", "happy", "sad", "great",
+    "terrible", "is", "a", "the", "movie", "it", "i", "!", "!!", "!!!", "totally", "barely", ":)", ":(", ":D", ";)", "<3",
+    "and", "nice", "awful", ",", ".", "?", "...", "NOT", "Very", "didn't", "isn't", "pretty", "slightly", "love", "hate"]
+
+def generated(count, seed):
+    rnd = random.Random(seed)
+    return [" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 10))) for _ in range(count)]
+
+def check(texts):
+    polarity, subjectivity = batchsentiment.score_batch(texts)
+    for i, text in enumerate(texts):
+        expected = TextBlob(text).sentiment
+        assert abs(polarity[i] - expected.polarity) <= batchsentiment.BATCH_TOLERANCE, text
+        assert abs(subjectivity[i] - expected.subjectivity) <= batchsentiment.BATCH_TOLERANCE, text
+
+def test_chains():
+    check(CHAINS)
+
+def test_chains_one_at_a_time():
+    for text in CHAINS:
+        check([text])
+
+def test_generated():
+    check(generated(5000, seed=7))
+
+def test_agreement_report():
+    texts = generated(500, seed=11)
+    within, total, worst = batchsentiment.check_agreement(texts)
+    assert within == total == len(texts)
+    assert worst <= batchsentiment.BATCH_TOLERANCE
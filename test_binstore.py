@@ -0,0 +1,52 @@
+# a binary analysis has to load back as the same analysis its json would.
+# run with: python -m pytest test_binstore.py
+import json
+import messages as msgs
+import binstore
+from test_messages import generated_messages
+
+def analysis(topk=None):
+    old = msgs.TOPK_CAPACITY
+    msgs.TOPK_CAPACITY = topk
+    try:
+        td = msgs.analyze_messages(generated_messages(3000, seed=9), [msgs.TimePeriod.MONTH, msgs.TimePeriod.DAY], tz="Europe/London")
+    finally:
+        msgs.TOPK_CAPACITY = old
+    td.prefix_index()
+    return td
+
+def plain(td):
+    return json.loads(json.dumps(td.serializable(), default=msgs.encode_special))
+
+def saved_both_ways(td, tmp_path):
+    jsonfile = str(tmp_path / "analysis.json")
+    binfile = str(tmp_path / ("analysis" + msgs.BINARY_EXTENSION))
+    msgs.save_analysis(td, jsonfile)
+    msgs.save_analysis(td, binfile)
+    return msgs.load_analysis(jsonfile), binfile
+
+def test_round_trip(tmp_path):
+    for topk in (None, 20):
+        fromjson, binfile = saved_both_ways(analysis(topk), tmp_path)
+        assert binstore.isbinary(binfile)
+        assert plain(msgs.load_analysis(binfile, lazy=False)) == plain(fromjson)
+
+def test_lazy_reads(tmp_path):
+    td = analysis()
+    fromjson, binfile = saved_both_ways(td, tmp_path)
+    lazy = msgs.load_analysis(binfile)
+    assert (lazy.tz, lazy.latest_ms, lazy.settings) == (fromjson.tz, fromjson.latest_ms, fromjson.settings)
+    for period in lazy.periods:
+        a, b = lazy.get(period), fromjson.get(period)
+        assert list(a.trcounts) == list(b.trcounts)
+        for key in list(b.trcounts)[::7]:
+            assert dict(a.trcounts[key].allcount["words_use"]) == dict(b.trcounts[key].allcount["words_use"])
+            assert a.trcounts[key].allcount["msg"] == b.trcounts[key].allcount["msg"]
+            assert a.ranked("emoji_use", key) == b.ranked("emoji_use", key)
+    # the prefix index is only saved in binary analyses, and answers like one built from the counts
+    assert lazy.finest().indexfield is not None
+    window = (td.finest().getallkeys()[3], td.finest().getallkeys()[15])
+    assert plain_count(lazy.query(*window)) == plain_count(fromjson.query(*window)) == plain_count(td.query(*window))
+
+def plain_count(trc):
+    return json.loads(json.dumps(trc.serializable(), default=msgs.encode_special))
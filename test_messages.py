@@ -0,0 +1,154 @@
+# run with: python -m pytest test_messages.py
+import io, json
+import messages as msgs
+
+# a history as Messenger writes it: every utf-8 byte of text escaped as its own \u00XX character.
+# fix_history fixes whole strings, streaming fixes each run of escapes, so a string is either all valid or all not
+HISTORY = r"""{
+  "participants": [{"name": "Zo\u00c3\u00ab"}, {"name": "Al"}],
+  "title": "caf\u00c3\u00a9 \u00f0\u009f\u0098\u0080",
+  "messages": [
+    {"sender_name": "Zo\u00c3\u00ab", "timestamp_ms": 1500000000000, "content": "\u00f0\u009f\u0098\u0080\u00f0\u009f\u0098\u0080 hi \u00f0\u009f\u0087\u00ba\u00f0\u009f\u0087\u00b8"},
+    {"sender_name": "Al", "timestamp_ms": 1500000001000, "content": "a literal \\u00e9 and \\u00c3\\u00a9, then \\\u00c3\u00a9"},
+    {"sender_name": "Al", "timestamp_ms": 1500000002000, "content": "back\\\\slashes \\\\\\u00f0 \u00e2\u009d\u00a4\u00ef\u00b8\u008f",
+      "reactions": [{"reaction": "\u00f0\u009f\u0098\u0086", "actor": "Zo\u00c3\u00ab"}]},
+    {"sender_name": "Zo\u00c3\u00ab", "timestamp_ms": 1500000003000, "content": "not utf-8: \u00ff\u00fe, cut short: \u00f0\u009f"},
+    {"sender_name": "Al", "timestamp_ms": 1500000004000, "sticker": {"uri": "stickers/\u00c3\u00a9.png"}, "content": "\u00c2\u00a9 2017"}
+  ]
+}"""
+
+def expected(text):
+    return msgs.fix_history(json.loads(text))
+
+def test_history_is_repaired():
+    messages = expected(HISTORY)["messages"]
+    assert messages[0]["sender_name"] == "Zoë"
+    assert messages[0]["content"] == "😀😀 hi 🇺🇸"
+    assert messages[1]["content"] == "a literal \\u00e9 and \\u00c3\\u00a9, then \\é"
+    assert messages[2]["reactions"][0]["reaction"] == "😆"
+    assert list(msgs.iter_messages_fp(io.StringIO(HISTORY))) == messages
+
+# escape runs (and escaped backslashes before them) cut anywhere by the chunks read
+def test_every_chunk_size():
+    header_expected = expected(HISTORY)
+    messages = header_expected.pop("messages")
+    for chunksize in range(1, len(HISTORY) + 1):
+        header = {}
+        assert list(msgs.iter_messages_fp(io.StringIO(HISTORY), header, chunksize=chunksize)) == messages, chunksize
+        assert header == header_expected, chunksize
+
+def test_unrepaired():
+    messages = json.loads(HISTORY)["messages"]
+    for chunksize in (1, 2, 3, 7, 64):
+        assert list(msgs.iter_messages_fp(io.StringIO(HISTORY), chunksize=chunksize, repair=False)) == messages
+
+def test_loadjson_repair(tmp_path):
+    path = tmp_path / "history.json"
+    path.write_text(HISTORY)
+    assert msgs.loadjson(str(path), repair=True) == expected(HISTORY)
+    assert msgs.loadjson(str(path)) == json.loads(HISTORY)
+
+# emoji both matchers find the same way: single pictographs that are emoji by default, flags
+SAME_EMOJI = ["😀", "hi 😀😀 there", "lol 😂😂😂", "🎉 congrats 🎂", "⌛ wait", "⚡⚡", "✨✅❌", "🇺🇸 vs 🇫🇷", "🤔", "🥺👉👈",
+    "plain text", "café naïve", "", "🐶🐱 and 🦊"]
+# (text, what the legacy matcher finds, what find_emoji finds): sequences it split up (joiners and all),
+# and symbols that aren't emoji
+DIFFERENT_EMOJI = [
+    ("© 2017", ["©"], []),
+    ("in — out", ["—"], []),
+    ("a → b", ["→"], []),
+    ("I ❤ u", ["❤"], []),
+    ("I ❤️ u", ["❤"], ["❤️"]),
+    ("✔️ done ✔", ["✔", "✔"], ["✔️"]),
+    ("👍🏽", ["👍", "🏽"], ["👍🏽"]),
+    ("☝🏽", ["☝", "🏽"], ["☝🏽"]),
+    ("👩\u200d❤️\u200d👨", ["👩", "\u200d", "❤", "\u200d", "👨"], ["👩\u200d❤️\u200d👨"]),
+    ("🏳️\u200d🌈", ["🏳", "\u200d", "🌈"], ["🏳️\u200d🌈"]),
+]
+
+def raw(text):
+    return text.encode("utf-8").decode("latin-1")
+
+def test_emoji_against_legacy():
+    import bench
+    for text in SAME_EMOJI:
+        assert msgs.find_emoji(text) == bench.legacy_find_emoji(raw(text)), text
+    for text, legacy, found in DIFFERENT_EMOJI:
+        assert bench.legacy_find_emoji(raw(text)) == legacy, text
+        assert msgs.find_emoji(text) == found, text
+
+WORDS = ["hi", "hello", "ok", "lol", "yes", "no", "good", "bad", "see", "you", "tomorrow", "😀", "😂😂", "❤️", "🇺🇸"]
+
+def generated_messages(count, seed):
+    import random
+    rnd = random.Random(seed)
+    names = ["Zoë", "Al", "Bo"]
+    messages = []
+    for i in range(count):
+        msg = {"sender_name": rnd.choice(names), "timestamp_ms": 1500000000000 + i * 600000 + rnd.randint(0, 599999)}
+        kind = rnd.random()
+        if kind < 0.1:
+            msg["sticker"] = {"uri": "stickers/{}.png".format(rnd.randint(1, 5))}
+        elif kind < 0.15:
+            msg["share"] = {"link": "https://example{}.com/page".format(rnd.randint(1, 3))}
+        else:
+            msg["content"] = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 8)))
+        if rnd.random() < 0.2:
+            msg["reactions"] = [{"reaction": rnd.choice(["😆", "❤", "👍"]), "actor": rnd.choice(names)}]
+        messages.append(msg)
+    return messages
+
+# shards are always the same and merged in order, so the pool changes nothing
+def test_workers_serialize_identically():
+    messages = generated_messages(3 * msgs.SHARD_SIZE + 123, seed=3)
+    periods = [msgs.TimePeriod.MONTH, msgs.TimePeriod.DAY]
+    serial = msgs.analyze_messages(messages, periods, workers=1, tz="Europe/London")
+    parallel = msgs.analyze_messages(messages, periods, workers=3, tz="Europe/London")
+    assert json.dumps(serial.serializable(), default=msgs.encode_special) == json.dumps(parallel.serializable(), default=msgs.encode_special)
+
+# a long-tailed stream of items, split into parts like shards
+def zipf_parts(parts, size, seed):
+    import random
+    rnd = random.Random(seed)
+    items = ["w{}".format(i) for i in range(2000)]
+    weights = [1 / (i + 1) for i in range(len(items))]
+    return [rnd.choices(items, weights, k=size) for _ in range(parts)]
+
+def check_topcounter(tc, exact):
+    assert tc.total == sum(exact.values())
+    assert len(tc.counts) <= tc.capacity
+    for item, count in tc.counts.items():
+        # never under, and over by at most the item's error
+        assert count - tc.errors.get(item, 0) <= exact[item] <= count, item
+    for item, count in exact.items():
+        if item not in tc.counts:
+            assert count <= tc.floor(), item
+        if count > tc.total / tc.capacity:
+            assert item in tc.counts, item
+    assert tc.error_bound() <= tc.total / tc.capacity
+
+def test_topcounter_merge():
+    from collections import Counter
+    parts = zipf_parts(6, 3000, seed=5)
+    exact = Counter()
+    merged = msgs.TopCounter(100)
+    for part in parts:
+        tc = msgs.TopCounter(100)
+        tc.update(part)
+        check_topcounter(tc, Counter(part))
+        merged.merge(tc)
+        exact.update(part)
+        check_topcounter(merged, exact)
+    # the same bounds as counting the whole stream in one go
+    check_topcounter(msgs.TopCounter(100).update([item for part in parts for item in part]), exact)
+
+def test_topcounter_exact_under_capacity():
+    from collections import Counter
+    parts = [["a", "b", "a"], ["c", "a"], ["b", "d"]]
+    merged = msgs.TopCounter(10)
+    for part in parts:
+        merged.merge(msgs.TopCounter(10).update(part))
+    assert merged.counts == dict(Counter(item for part in parts for item in part))
+    assert merged.error_bound() == 0
+    decoded = msgs.TopCounter.decode(json.loads(json.dumps(merged.serializable())))
+    assert decoded.counts == merged.counts and decoded.total == merged.total
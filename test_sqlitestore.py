@@ -0,0 +1,44 @@
+# messages saved into a database alongside its analysis have to be saved once, however often it's updated.
+# run with: python -m pytest test_sqlitestore.py
+import sqlite3
+import messages as msgs
+import sqlitestore
+from test_messages import generated_messages
+
+def history():
+    messages = generated_messages(2 * msgs.SHARD_SIZE + 500, seed=13)
+    # the same message twice (both are kept), and one that can't be placed in time
+    messages.insert(100, dict(messages[100]))
+    messages.append({"sender_name": "Al", "content": "no timestamp"})
+    return messages
+
+def rows(filename, table):
+    conn = sqlite3.connect(filename)
+    count = conn.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+    conn.close()
+    return count
+
+def test_repeated_updates(tmp_path):
+    filename = str(tmp_path / ("analysis" + msgs.SQLITE_EXTENSION))
+    messages = history()
+    first = messages[:msgs.SHARD_SIZE + 300]
+
+    writer = sqlitestore.MessageWriter(filename)
+    td = msgs.analyze_messages(writer.tee(first))
+    msgs.save_analysis(td, filename)
+    assert writer.count == len(first)
+
+    # every update reads the whole (longer) history through the writer, as messages.py --update does
+    saved = [writer.count]
+    for _ in range(3):
+        writer = sqlitestore.MessageWriter(filename)
+        td = msgs.update_analysis(msgs.load_analysis(filename), writer.tee(messages))
+        msgs.save_analysis(td, filename)
+        saved.append(writer.count)
+    assert saved == [len(first), len(messages) - len(first), 0, 0]
+
+    assert rows(filename, "messages") == len(messages)
+    assert rows(filename, "reactions") == sum(len(msg.get("reactions", [])) for msg in messages)
+    assert rows(filename, "stickers") == sum(1 for msg in messages if "sticker" in msg)
+    counted = [msg for msg in messages if "timestamp_ms" in msg]
+    assert msgs.load_analysis(filename).alltime().allcount["msg"] == len(counted)